@@ -0,0 +1,148 @@
+#!/usr/bin/python2
+""" Align and count in one step, without writing SAM files.
+
+The SAM output of each bowtie2 job goes straight into htseq_count_umified, in
+the same process that started bowtie2. The per-sample SAM files, which are the
+largest files of the pipeline, are only written if asked to (`keep_sam`):
+
+  - none : no SAM files.
+  - sam  : a SAM file for each sample in output_dir, as bowtie_wrapper writes it.
+  - bam  : a BAM file for each sample, written by `samtools view -b`.
+
+The jobs are scheduled as in bowtie_wrapper. Each job also needs a core for the
+counting, which is not included in its bowtie2 threads.
+Writes the bowtie report and the count matrix, as bowtie_wrapper and
+htseq_wrapper do.
+"""
+
+import os
+import threading
+import subprocess
+from logging import getLogger
+from collections import Counter
+from multiprocessing import Pool
+
+import bowtie_wrapper
+import collapse_reads
+import count_matrix
+import htseq_wrapper
+import htseq_count_umified
+
+logger = getLogger('pijp.align_count')
+
+KEEP_SAM = ("none", "sam", "bam")
+
+
+def open_kept(keep_sam, fastq_file, output_dir):
+    """ Returns (file to write SAM lines to, samtools process) for the kept alignments """
+    if keep_sam == "none":
+        return None, None
+    sam_file = bowtie_wrapper.sam_filename(fastq_file, output_dir)
+    if keep_sam == "sam":
+        return open(sam_file, "wb"), None
+    bam_file = os.path.splitext(sam_file)[0] + ".bam"
+    samtools = subprocess.Popen(["samtools", "view", "-b", "-o", bam_file, "-"], stdin=subprocess.PIPE)
+    return samtools.stdin, samtools
+
+
+def sam_lines(bowtie_stdout, stats, table, kept):
+    """ Yield the SAM lines of bowtie2, expanded with the collapse `table` if
+        they are collapsed reads. The alignments are counted in `stats`, and
+        written to `kept`, if any.
+    """
+    on_alignment = lambda rest, reads: bowtie_wrapper.count_alignment(stats, rest, reads)
+    for line in bowtie_stdout:
+        if table is not None:
+            lines = collapse_reads.expand_sam([line], table, on_alignment)
+        else:
+            if not line.startswith("@"):
+                bowtie_wrapper.count_alignment(stats, line.split("\t", 1)[1])
+            lines = [line]
+        for line in lines:
+            if kept is not None:
+                kept.write(line)
+            yield line
+
+
+def align_and_count((cmd, name, expand, fastq_file, output_dir, keep_sam, gff_file, htseq_params, index_dir)):
+    """ Run bowtie2 and count its output.
+        Returns (report row, warnings, (feats, counts) or None).
+    """
+    logger.info("ran  : " + cmd)
+    table = collapse_reads.read_table(expand[1]) if expand is not None else None
+    pro = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    warnings = Counter()
+    stderr = []
+    read_stderr = lambda: stderr.extend(bowtie_wrapper.read_stderr(pro.stderr, warnings, tables=table))
+    stderr_reader = threading.Thread(target=read_stderr)
+    stderr_reader.start()
+    stats = Counter()
+    kept, samtools = open_kept(keep_sam, fastq_file, output_dir)
+    args = htseq_wrapper.build_argument_opts(htseq_params)
+    try:
+        lines = sam_lines(pro.stdout, stats, table, kept)
+        try:
+            counts = htseq_count_umified.count_reads_in_features( lines, gff_file, args.stranded,
+                     args.mode, args.featuretype, args.idattr, args.quiet, args.minaqual,
+                     args.samout, args.umis, index_dir, args.engine, args.cache_size, args.umi_collapse)
+        except htseq_count_umified.EmptySamError:
+            logger.exception("HTSeq error with %s", name)
+            counts = None
+        # the counter may stop early, but bowtie2 must finish writing.
+        for line in lines:
+            pass
+    except:
+        # nothing reads bowtie2's output any more, so it could block writing it
+        pro.kill()
+        pro.stdout.close()
+        raise
+    finally:
+        stderr_reader.join()
+        pro.wait()
+        if kept is not None:
+            kept.close()
+        if samtools is not None:
+            samtools.wait()
+    assert (pro.returncode == 0 ), "bowtie error %d : %s" % (pro.returncode, "".join(stderr))
+    assert (samtools is None or samtools.returncode == 0), "samtools error writing the BAM of %s" % name
+    bowtie_wrapper.log_warnings(name, warnings)
+    logger.info("finished  : " + cmd)
+    return [name] + bowtie_wrapper.format_sam_stats(stats), warnings, counts
+
+
+def main(input_files, index_file, gff_file, output_dir, count_filename, bowtie_report_name="bt_report.tab",
+         number_of_threads=3, bowtie_params="", htseq_params="", umi="false", keep_sam="none",
+         procs=10, cores=0, memory=0, mm="false", feature_cache="", engine="htseq",
+         umi_collapse="none", matrix_format="tsv"):
+    """ Align and count every sample. Writes the bowtie report and the count matrix. """
+    assert (keep_sam in KEEP_SAM), "Unknown keep_sam %s" % keep_sam
+    assert (matrix_format in count_matrix.FORMATS), "Unknown matrix format %s" % matrix_format
+    if umi.lower() in ["true","yes","1"]:
+        htseq_params += " -u --umi-collapse " + umi_collapse
+    htseq_params += " -e " + engine
+    index_dir = htseq_wrapper.build_feature_index(htseq_params, gff_file,
+                                                  feature_cache or os.path.join(output_dir, "feature_index"))
+    base_names, jobs, entries = bowtie_wrapper.list_jobs(input_files, output_dir)
+    bowtie_params = bowtie_wrapper.mm_params(bowtie_params, mm)
+    cores, max_jobs, min_threads = bowtie_wrapper.alignment_budget(cores, memory, procs, number_of_threads,
+                                                                   index_file, bowtie_params)
+    logger.info("aligning and counting %d samples, up to %d at once, on %d cores", len(jobs), max_jobs, cores)
+    make_cmd = lambda i, threads: bowtie_wrapper.build_bowtie_command(entries[i][1], index_file, threads, None,
+                                                                      bowtie_params, entries[i][2])
+    fastq_files = dict((name, fastq_file) for (name, fastq_file, stream_cmd, expand) in entries)
+
+    # the scheduler's threads wait for the jobs, which count in separate processes.
+    pool = Pool(max_jobs)
+    def run((cmd, name, expand)):
+        job = (cmd, name, expand, fastq_files[name], output_dir, keep_sam, gff_file, htseq_params, index_dir)
+        return pool.apply(align_and_count, (job,))
+    try:
+        results = bowtie_wrapper.run_scheduled(jobs, make_cmd, cores, max_jobs, min_threads, run)
+    finally:
+        pool.close()
+        pool.join()
+
+    bowtie_wrapper.write_report([(row, warnings) for row, warnings, counts in results],
+                                os.path.join(output_dir, bowtie_report_name))
+    htseq_wrapper.write_matrix([counts for row, warnings, counts in results], base_names,
+                               os.path.join(output_dir, count_filename), matrix_format)
@@ -0,0 +1,208 @@
+#!/usr/bin/python2
+""" A batch engine for count_reads_in_features (engine "numpy").
+
+Instead of one HTSeq alignment at a time, the SAM lines are parsed in batches
+into numpy arrays of M blocks (read number, chromosome/strand vector, start,
+end). The steps of the feature index (see feature_index.py) that each block
+overlaps are found with numpy.searchsorted, and the feature sets of most reads
+are then settled with array operations. Only reads that overlap more than one
+distinct feature set are combined in python, with the same union /
+intersection-strict / intersection-nonempty rules as htseq-count.
+
+Single-end reads only. count_reads_in_features uses the HTSeq loop for paired
+ends, and when the assigned SAM lines are written out (samout).
+"""
+
+from __future__ import print_function, division
+
+import re
+import itertools
+
+import numpy
+
+BATCH_SIZE = 100000
+CIGAR_OP = re.compile(r"([0-9]+)([MIDNSHP=X])")
+# the CIGAR operations that consume the reference
+REF_OPS = "MDN=X"
+INVERT = {"+": "-", "-": "+"}
+
+
+def m_blocks(cigar, cache):
+    """ The (start, end) of the M operations of a CIGAR string, relative to the position """
+    blocks = cache.get(cigar)
+    if blocks is None:
+        blocks = []
+        offset = 0
+        for size, op in CIGAR_OP.findall(cigar):
+            size = int(size)
+            if op == "M" and size > 0:
+                blocks.append((offset, offset + size))
+            if op in REF_OPS:
+                offset += size
+        cache[cigar] = blocks
+    return blocks
+
+
+class BatchCounter(object):
+    """ Counts single-end SAM lines against a FeatureIndex.
+        Adds to the `counts` dict (feature id -> count), calls count_umis(feature
+        id, read name) for every counted read, and keeps the summary counters.
+    """
+
+    def __init__(self, index, stranded, overlap_mode, minaqual, counts, count_umis=None):
+        if overlap_mode not in ("union", "intersection-strict", "intersection-nonempty"):
+            raise ValueError("Illegal overlap mode.")
+        self.index = index
+        self.stranded = stranded
+        self.overlap_mode = overlap_mode
+        self.minaqual = minaqual
+        self.counts = counts
+        self.count_umis = count_umis
+        self.feature_ids = index.feature_ids
+        self.feature_numbers = dict((feature_id, n) for n, feature_id in enumerate(self.feature_ids))
+        self.sets = index.sets
+        self.set_sizes = numpy.array([len(fs) for fs in self.sets], dtype=numpy.int64)
+        self.set_feature = numpy.array([self.feature_numbers[list(fs)[0]] if len(fs) == 1 else -1
+                                        for fs in self.sets], dtype=numpy.int64)
+        self.vector_keys = sorted(index.vectors)
+        self.vector_ids = dict((key, n) for n, key in enumerate(self.vector_keys))
+        self.feature_counts = numpy.zeros(len(self.feature_ids), dtype=numpy.int64)
+        self.cigars = dict()
+        self.empty = 0
+        self.ambiguous = 0
+        self.notaligned = 0
+        self.lowqual = 0
+        self.nonunique = 0
+        self.reads = 0
+
+    def count(self, sam_lines, batch_size=BATCH_SIZE):
+        """ Count all the lines. Returns the summary counters
+            (empty, ambiguous, lowqual, notaligned, nonunique)
+        """
+        sam_lines = iter(sam_lines)
+        while True:
+            batch = list(itertools.islice(sam_lines, batch_size))
+            if not batch:
+                break
+            self.count_batch(batch)
+        for n, count in enumerate(self.feature_counts):
+            if count:
+                self.counts[self.feature_ids[n]] += int(count)
+        return (self.empty, self.ambiguous, self.lowqual, self.notaligned, self.nonunique)
+
+    def parse(self, batch):
+        """ The read names, and the arrays of M blocks, of the reads that are to be assigned """
+        names = []
+        block_read = []
+        block_vector = []
+        block_start = []
+        block_end = []
+        chrom_vectors = self.index.chrom_vectors
+        for line in batch:
+            if line.startswith("@"):
+                continue
+            self.reads += 1
+            fields = line.split("\t", 6)
+            flag = int(fields[1])
+            if flag & 4:
+                self.notaligned += 1
+                continue
+            nh = line.find("\tNH:i:")
+            if nh != -1 and int(line[nh + 6:].split("\t", 1)[0]) > 1:
+                self.nonunique += 1
+                continue
+            if int(fields[4]) < self.minaqual:
+                self.lowqual += 1
+                continue
+            chrom = fields[2]
+            if chrom not in chrom_vectors:
+                self.empty += 1
+                continue
+            if self.stranded == "no":
+                strand = "."
+            else:
+                strand = "-" if flag & 16 else "+"
+                if self.stranded == "reverse":
+                    strand = INVERT[strand]
+            vector = self.vector_ids[(chrom, strand)]
+            pos = int(fields[3]) - 1
+            read = len(names)
+            names.append(fields[0])
+            for start, end in m_blocks(fields[5], self.cigars):
+                block_read.append(read)
+                block_vector.append(vector)
+                block_start.append(pos + start)
+                block_end.append(pos + end)
+        return (names, numpy.array(block_read, dtype=numpy.int64), numpy.array(block_vector, dtype=numpy.int64),
+                numpy.array(block_start, dtype=numpy.int64), numpy.array(block_end, dtype=numpy.int64))
+
+    def step_sets(self, block_read, block_vector, block_start, block_end):
+        """ (read, set number) of every step that every block overlaps """
+        reads = []
+        set_numbers = []
+        for vector in numpy.unique(block_vector):
+            starts, values = self.index.vectors[self.vector_keys[vector]]
+            mask = block_vector == vector
+            first = numpy.searchsorted(starts, block_start[mask], "right") - 1
+            last = numpy.searchsorted(starts, block_end[mask], "left")
+            steps = last - first
+            # expand each block to the steps first, first + 1, .. last - 1
+            offsets = numpy.arange(steps.sum()) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+            reads.append(numpy.repeat(block_read[mask], steps))
+            set_numbers.append(numpy.asarray(values)[numpy.repeat(first, steps) + offsets])
+        if not reads:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(reads), numpy.concatenate(set_numbers).astype(numpy.int64)
+
+    def count_batch(self, batch):
+        names, block_read, block_vector, block_start, block_end = self.parse(batch)
+        n_reads = len(names)
+        if n_reads == 0:
+            return
+        reads, set_numbers = self.step_sets(block_read, block_vector, block_start, block_end)
+        empty_step = numpy.zeros(n_reads, dtype=bool)
+        if self.overlap_mode == "intersection-strict":
+            empty_step[reads[set_numbers == 0]] = True
+        else:
+            # empty steps do not change a union, and are skipped by intersection-nonempty
+            keep = set_numbers != 0
+            reads, set_numbers = reads[keep], set_numbers[keep]
+        # the distinct sets of each read
+        n_sets = len(self.sets)
+        keys = numpy.unique(reads * n_sets + set_numbers)
+        reads, set_numbers = keys // n_sets, keys % n_sets
+        distinct = numpy.bincount(reads, minlength=n_reads)
+        read_set = numpy.zeros(n_reads, dtype=numpy.int64)
+        read_set[reads] = set_numbers
+
+        features = numpy.full(n_reads, -1, dtype=numpy.int64)
+        single = (distinct == 1) & ~empty_step
+        sizes = numpy.where(single, self.set_sizes[read_set], 0)
+        self.empty += int(((distinct == 0) | empty_step | (single & (sizes == 0))).sum())
+        self.ambiguous += int((sizes > 1).sum())
+        found = single & (sizes == 1)
+        features[found] = self.set_feature[read_set[found]]
+
+        # reads with several distinct sets are combined in python
+        multi = (distinct > 1) & ~empty_step
+        if multi.any():
+            read_sets = dict()
+            for read, set_number in zip(reads[multi[reads]], set_numbers[multi[reads]]):
+                read_sets.setdefault(read, []).append(self.sets[set_number])
+            for read, sets in read_sets.iteritems():
+                if self.overlap_mode == "union":
+                    fs = set().union(*sets)
+                else:
+                    fs = sets[0].intersection(*sets[1:])
+                if len(fs) == 0:
+                    self.empty += 1
+                elif len(fs) > 1:
+                    self.ambiguous += 1
+                else:
+                    features[read] = self.feature_numbers[list(fs)[0]]
+
+        counted = features >= 0
+        self.feature_counts += numpy.bincount(features[counted], minlength=len(self.feature_ids))
+        if self.count_umis is not None:
+            for read in numpy.flatnonzero(counted):
+                self.count_umis(self.feature_ids[features[read]], names[read])
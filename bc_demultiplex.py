@@ -7,6 +7,26 @@ The fastq files are assumed to be read1 (the barcode), and the script replaces
 "_R1_" with "_R2_" to find the second file. If the filename ends in `gz` it
 is decompressed on-the-fly (HTSeq does that).
 
+With more than one process (`--procs`), every R1/R2 pair is split by its own
+worker into per-sample part files, which are concatenated in input order at
+the end, so the output is the same as that of a serial run. With `--chunks`,
+each uncompressed or BGZF pair is also cut into that many synchronized chunks
+(see fastq_input.py), so that a single large pair can use several processes.
+
+With `--max-bc-mismatches` (1 or 2), a barcode with sequencing errors is
+assigned to the nearest known barcode, if there is only one nearest barcode.
+The number of corrected reads of each sample is added to the stats file.
+
+Gzipped inputs can be decompressed by read-ahead threads (`--readahead`).
+
+The output files can be compressed with gzip or BGZF (`--compression`), on a
+pool of background threads (see fastq_output.py). With `--container`, all the
+samples are written into one container file instead (see fastq_container.py).
+
+There are two splitting engines: "htseq" (the default) reads with HTSeq's
+FastqReader, and "raw" works directly on batches of FASTQ lines, which is
+much faster. Both write exactly the same files.
+
 """
 
 from __future__ import print_function, division
@@ -14,89 +34,229 @@ from __future__ import print_function, division
 import os
 import argparse
 import csv
+import string
+from itertools import combinations, product
 from logging import getLogger
 from itertools import izip, tee
 from collections import OrderedDict, namedtuple, Counter
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 
 from HTSeq import FastqReader, SequenceWithQualities
 from Bio import Seq
 
+import fastq_input
+import fastq_output
+import fastq_container
+
 FN_SCHEME = "{0.project}_{0.series}_sample_{0.id}.fastq"
 FN_UNKNOWN = "undetermined_{0}.fastq"
+FN_PART = "{0}.part{1:04}"
+
+# the "data types" of the sample sheet. These are module level, so they can be
+# pickled and sent to worker processes.
+SampleKey = namedtuple('SampleKey', ['flocell', 'lane', 'il_barcode', 'cel_barcode'])
+Sample = namedtuple('Sample', ['id', 'series', 'project'])
+# the key of the corrected reads count of a sample in the sample counter
+Corrected = namedtuple('Corrected', ['sample'])
+
+# 2-bit encoding of barcodes: the barcode is read as a base 4 number.
+# Any other character (e.g. N) makes int() fail.
+BASE_DIGITS = string.maketrans("ACGT", "0123")
+# longer barcodes are routed with a dict instead of a list
+MAX_TABLE_BC_LENGTH = 10
 
 logger = getLogger('pijp.bc_demultiplex')
 debug, info = logger.debug, logger.info
 
-def main(bc_index_file, sample_sheet, input_files, stats_file, output_dir, min_bc_quality, umi_length=0, bc_length=8, cut_length=35):
+def main(bc_index_file, sample_sheet, input_files, stats_file, output_dir, min_bc_quality, umi_length=0, bc_length=8, cut_length=35, procs=1, chunks=1, engine="htseq", max_bc_mismatches=0,
+         output_compression="none", compression_level=6, compression_threads=1, write_buffer_size=fastq_output.BUFFER_SIZE,
+         output_container="", readahead="false"):
     """ this is the main function of this module. Does the splitting 
         and calls any other function.
     """
-    cut_length = int(cut_length)
+    procs = int(procs)
+    assert (engine in SPLITTERS), "Unknown engine %s. Use one of: %s" % (engine, ", ".join(SPLITTERS))
+    max_bc_mismatches = int(max_bc_mismatches)
+    split_args = dict(min_bc_quality=min_bc_quality, umi_length=int(umi_length),
+                      bc_length=int(bc_length), cut_length=int(cut_length), engine=engine,
+                      max_bc_mismatches=max_bc_mismatches,
+                      readahead=str(readahead).lower() in ["true", "yes", "1"])
+    output_args = dict(compression=output_compression, level=int(compression_level),
+                       threads=int(compression_threads), buffer_size=int(write_buffer_size),
+                       container=output_container)
     bc_dict = create_bc_dict(bc_index_file)
     sample_dict = create_sample_dict(sample_sheet)
-    files_dict = create_output_files(sample_dict, output_dir)
 
-    try:
-        sample_counter = Counter()
-        for fastq_file in input_files:
-            logger.info("splitting file %s", fastq_file)
-            r1_file = fastq_file
-        
-            # derive lane and il_barcode from filename
-            split_name = os.path.basename(fastq_file).split("_")
-            il_barcode = split_name[0]
-            lane = split_name[2]
+    jobs = split_jobs(input_files, int(chunks))
+    if procs > 1 and len(jobs) > 1:
+        sample_counter = split_parallel(bc_dict, sample_dict, jobs, output_dir, procs, split_args, output_args)
+    else:
+        files_dict = create_output_files(sample_dict, output_dir, **output_args)
+        try:
+            sample_counter = Counter()
+            for fastq_file, chunk in jobs:
+                # run the splitter on this file, and collect the counts
+                sample_counter += split_file(bc_dict, sample_dict, files_dict, fastq_file, chunk=chunk, **split_args)
+        finally:
+            fastq_output.close_output_files(files_dict)
+
+    write_stats(sample_counter, sample_dict, os.path.join(output_dir, stats_file),
+                corrections=(max_bc_mismatches > 0))
+
+def write_stats(sample_counter, sample_dict, stats_filename, corrections=False):
+    """ Create the stats file. With `corrections`, add a column with the number
+        of reads whose barcode was corrected.
+    """
+    total = sum(count for key, count in sample_counter.items() if not isinstance(key, Corrected))
+    stats = [["# Sample_id", "reads", "precentage"]]
+    if corrections:
+        stats[0].append("bc_corrected")
     
-            # run the splitter on this file, and collect the counts
-            sample_counter += bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode, r1_file , int(umi_length), int(bc_length), cut_length)
+    # a sample can appear more than once in the sample dict,
+    # but we do not want to use set as it is unordered. 
+    samples = OrderedDict(((x, True) for x in sample_dict.values()))
     
-        ### Create the stats file.
-        total = sum(sample_counter.values())
-        stats = [["# Sample_id", "reads", "precentage"]]
-        
-        # a sample can appear more than once in the sample dict,
-        # but we do not want to use set as it is unordered. 
-        samples = OrderedDict(((x, True) for x in sample_dict.values()))
-        
-        for sample in samples.keys():
-            sample_count = sample_counter[sample]
-            stats.append( [FN_SCHEME.format(sample), sample_count, 100.0*sample_count/total])
-        stats.append( ["unqualified", sample_counter['unqualified'], 100.0*sample_counter['unqualified']/total])
-        stats.append( ["undetermined", sample_counter['undetermined'], 100.0*sample_counter['undetermined']/total])
-        stats.append( ["total", total, 100])
-        with open(os.path.join(output_dir,stats_file), "w") as stats_fh:
-            stats_writer = csv.writer(stats_fh, delimiter='\t')
-            stats_writer.writerows(stats)
-    finally:        
-        for file in files_dict.values():
-            file.close()
-
-def create_output_files(sample_dict, target):
-
-    files_dict = dict()
+    for sample in samples.keys():
+        sample_count = sample_counter[sample]
+        stats.append( [FN_SCHEME.format(sample), sample_count, 100.0*sample_count/total])
+        if corrections:
+            stats[-1].append(sample_counter[Corrected(sample)])
+    stats.append( ["unqualified", sample_counter['unqualified'], 100.0*sample_counter['unqualified']/total])
+    stats.append( ["undetermined", sample_counter['undetermined'], 100.0*sample_counter['undetermined']/total])
+    if corrections:
+        # no barcode was corrected for these reads
+        stats[-2].append(0)
+        stats[-1].append(0)
+    stats.append( ["total", total, 100])
+    if corrections:
+        stats[-1].append(sum(count for key, count in sample_counter.items() if isinstance(key, Corrected)))
+    with open(stats_filename, "w") as stats_fh:
+        stats_writer = csv.writer(stats_fh, delimiter='\t')
+        stats_writer.writerows(stats)
+
+def split_jobs(input_files, chunks):
+    """ List the (fastq_file, chunk) units of work. `chunk` is None for a whole file. """
+    jobs = []
+    for fastq_file in input_files:
+        ranges = None
+        if chunks > 1:
+            ranges = fastq_input.chunk_pair(fastq_file, r2_filename(fastq_file), chunks)
+        if ranges is None:
+            jobs.append((fastq_file, None))
+        else:
+            jobs.extend((fastq_file, chunk) for chunk in ranges)
+    return jobs
+
+def split_file(bc_dict, sample_dict, files_dict, fastq_file, min_bc_quality, umi_length, bc_length, cut_length, engine="htseq", max_bc_mismatches=0, readahead=False, chunk=None):
+    """ Split one R1/R2 pair (or one chunk of it) into the files of `files_dict`.
+        Returns the sample counter.
+    """
+    if chunk is None:
+        logger.info("splitting file %s", fastq_file)
+    else:
+        logger.info("splitting file %s, chunk %s", fastq_file, chunk)
+
+    lane, il_barcode = file_lane_barcode(fastq_file)
+    splitter = SPLITTERS[engine]
+    return splitter(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode, fastq_file, umi_length, bc_length, cut_length, chunk, max_bc_mismatches, readahead)
+
+def file_lane_barcode(fastq_file):
+    """ The (lane, il_barcode) of an input file, from its name """
+    # derive lane and il_barcode from filename
+    split_name = os.path.basename(fastq_file).split("_")
+    return split_name[2], split_name[0]
+
+def file_samples(fastq_file, sample_dict):
+    """ The samples that an input file can have reads of """
+    lane, il_barcode = file_lane_barcode(fastq_file)
+    return set(sample for key, sample in sample_dict.items()
+               if key.lane == lane and key.il_barcode == il_barcode)
+
+def split_part((part, fastq_file, chunk, bc_dict, sample_dict, output_dir, split_args, output_args)):
+    """ Worker process: split one file pair (or chunk) into its own set of part files. """
+    files_dict = create_output_files(sample_dict, output_dir, part, **output_args)
+    try:
+        return split_file(bc_dict, sample_dict, files_dict, fastq_file, chunk=chunk, **split_args)
+    finally:
+        fastq_output.close_output_files(files_dict)
+
+def split_parallel(bc_dict, sample_dict, jobs, output_dir, procs, split_args, output_args):
+    """ Split the input file pairs (or chunks) on `procs` processes, then merge
+        the part files in input order and sum the counters.
+    """
+    jobs = [(part, fastq_file, chunk, bc_dict, sample_dict, output_dir, split_args, output_args)
+            for part, (fastq_file, chunk) in enumerate(jobs)]
+    pool = Pool(min(procs, len(jobs)))
+    try:
+        counters = pool.map(split_part, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    if output_args["container"]:
+        container = os.path.join(output_dir, output_args["container"])
+        fastq_container.merge_parts(container, [FN_PART.format(container, part) for part in range(len(jobs))])
+    else:
+        merge_part_files(sample_dict, output_dir, range(len(jobs)), output_args["compression"])
+    return sum(counters, Counter())
+
+def merge_part_files(sample_dict, target, parts, compression="none"):
+    """ Concatenate the part files of every output file, in the given order,
+        and delete them.
+    """
+    for filename in output_filenames(sample_dict, target, compression).values():
+        merge_parts((filename, parts, compression))
+
+def merge_parts((filename, parts, compression)):
+    """ Concatenate the given part files of one output file, in order, and delete them """
+    logger.info("merging parts of %s", filename)
+    with open(filename, "wb") as out_fh:
+        for n, part in enumerate(parts):
+            part_filename = FN_PART.format(filename, part)
+            with open(part_filename, "rb") as part_fh:
+                # a BGZF file has only one end-of-file marker
+                last = (n == len(parts) - 1)
+                fastq_output.copy_part(part_fh, out_fh, strip_bgzf_eof=(compression == "bgzf" and not last))
+            os.remove(part_filename)
+
+def output_filenames(sample_dict, target, compression="none"):
+    """ Map each sample (and the undetermined reads) to its output file name """
+    extension = fastq_output.EXTENSIONS[compression]
+    filenames = dict()
     for sample in set(sample_dict.values()):
-        filename = os.path.join(target, FN_SCHEME.format(sample))
-        files_dict[sample] = open(filename,"wb")
-    filename = os.path.join(target, FN_UNKNOWN.format('R1'))
-    files_dict['unknown_bc_R1'] = open(filename, "wb")
-    filename = os.path.join(target, FN_UNKNOWN.format('R2'))
-    files_dict['unknown_bc_R2'] = open(filename, "wb")
-    return files_dict
+        filenames[sample] = os.path.join(target, FN_SCHEME.format(sample) + extension)
+    filenames['unknown_bc_R1'] = os.path.join(target, FN_UNKNOWN.format('R1') + extension)
+    filenames['unknown_bc_R2'] = os.path.join(target, FN_UNKNOWN.format('R2') + extension)
+    return filenames
+
+def create_output_files(sample_dict, target, part=None, compression="none", level=6, threads=1,
+                        buffer_size=fastq_output.BUFFER_SIZE, container=""):
+    """ Open the output files. If `part` is given, open part files instead.
+        With `container`, open writers into that container file, named as the
+        output files would be.
+    """
+    if container:
+        filename = os.path.join(target, container)
+        if part is not None:
+            filename = FN_PART.format(filename, part)
+        pool = fastq_output.compression_pool(compression, threads)
+        output = fastq_container.Container(filename, compression, level, pool, buffer_size)
+        return dict((key, output.writer(os.path.basename(name)))
+                    for key, name in output_filenames(sample_dict, target).items())
+    filenames = output_filenames(sample_dict, target, compression)
+    if part is not None:
+        filenames = dict((key, FN_PART.format(filename, part)) for key, filename in filenames.items())
+    return fastq_output.open_output_files(filenames, compression, level, threads, buffer_size)
     
 def create_sample_dict(sample_sheet_file):
     """  Create a mapping from sample keys to sample infos """
     sample_dict = OrderedDict()
-    # define the "data types"
-    Key = namedtuple('sample_key',['flocell', 'lane', 'il_barcode', 'cel_barcode'])
-    Sample_info = namedtuple('Sample', ['id', 'series', 'project'])
 
     with open(sample_sheet_file, 'rb') as sample_sheet_fh:
         sample_sheet_reader = csv.DictReader(sample_sheet_fh, delimiter='\t')
         for row in sample_sheet_reader:
             id = "{0:04}".format(int(row["#id"]))  #  id has an extra "#" becaues its the first field
-            key = Key(row["flocell"], row["lane"], row["il_barcode"], row["cel_barcode"])
-            sample_dict[key] = Sample_info(id, row["series"], row["project"])
+            key = SampleKey(row["flocell"], row["lane"], row["il_barcode"], row["cel_barcode"])
+            sample_dict[key] = Sample(id, row["series"], row["project"])
 
     return sample_dict                              
 
@@ -112,24 +272,183 @@ def create_bc_dict(bc_index_file):
     return bc_dict
 
 
-def get_sample(sample_dict, bc_dict, read, lane, il_barcode, umi_strt, umi_end, bc_strt, bc_end):
-    barcode = str(read.seq[bc_strt:bc_end])
-    cel_bc_id = bc_dict.get(barcode, None)
-    flocell = read.name.split(":")[2]
-    key = (flocell, lane, il_barcode, cel_bc_id)
-    return sample_dict.get(key ,None)
+def encode_barcode(barcode):
+    """ 2-bit encode a barcode to an integer. Returns None if it has non ACGT bases """
+    try:
+        return int(barcode.translate(BASE_DIGITS), 4)
+    except ValueError:
+        return None
 
+class _MissingSlots(dict):
+    def __missing__(self, key):
+        return -1
 
-def bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode, r1_file, umi_length, bc_length, cut_length):
-    """ Splits a fastq files according to barcode """
-    sample_counter = Counter()
-    umibc = umi_length + bc_length
-    freader1 = FastqReader(r1_file)
-    r1 = freader1
+def barcode_neighbours(code, bc_length, mismatches):
+    """ Yield the codes of all barcodes with exactly `mismatches` mismatches to `code` """
+    for positions in combinations(range(bc_length), mismatches):
+        # xor-ing a 2-bit base with 1, 2 or 3 gives the three other bases
+        for changes in product((1, 2, 3), repeat=mismatches):
+            yield code ^ sum(change << (2 * pos) for pos, change in zip(positions, changes))
+
+class BarcodeRouter(object):
+    """ Routes the reads of one input file (i.e. one lane and il_barcode) to
+        output slots. For each flowcell, a table maps the encoded barcode to
+        the index of the sample in `samples`, or to -1 for undetermined reads.
+
+        With `max_mismatches`, the table also holds every barcode that has a
+        single nearest known barcode within `max_mismatches`. These point to
+        slot + len(samples), so corrected reads are counted separately.
+    """
+
+    def __init__(self, bc_dict, sample_dict, lane, il_barcode, bc_length, max_mismatches=0):
+        self.bc_dict = bc_dict
+        self.sample_dict = sample_dict
+        self.lane = lane
+        self.il_barcode = il_barcode
+        self.bc_length = bc_length
+        self.max_mismatches = max_mismatches
+        # distinct samples, in sample sheet order
+        self.samples = list(OrderedDict(((x, True) for x in sample_dict.values())))
+        self.slots = dict((sample, slot) for slot, sample in enumerate(self.samples))
+        self._tables = {}
+        self._nearest = None
+        self._n_slots = {}
+
+    def nearest_barcodes(self):
+        """ Map the code of every barcode within `max_mismatches` of a known
+            barcode to (barcode, mismatches). Codes at the same distance from two
+            barcodes map to None. Does not depend on the flowcell, so it is built once.
+        """
+        if self._nearest is None:
+            barcodes = dict((encode_barcode(bc), bc) for bc in self.bc_dict
+                            if len(bc) == self.bc_length and encode_barcode(bc) is not None)
+            nearest = dict((code, (bc, 0)) for code, bc in barcodes.items())
+            for mismatches in range(1, self.max_mismatches + 1):
+                level = {}
+                for code, bc in barcodes.items():
+                    for neighbour in barcode_neighbours(code, self.bc_length, mismatches):
+                        if neighbour in nearest:
+                            # closer to some barcode, or already ambiguous
+                            continue
+                        if neighbour in level:
+                            level[neighbour] = None
+                        else:
+                            level[neighbour] = (bc, mismatches)
+                nearest.update(level)
+            self._nearest = nearest
+        return self._nearest
+
+    def table(self, flocell):
+        """ The routing table of a flowcell, built on first use """
+        if flocell not in self._tables:
+            if self.bc_length <= MAX_TABLE_BC_LENGTH:
+                table = [-1] * (4 ** self.bc_length)
+            else:
+                table = _MissingSlots()
+            for code, hit in self.nearest_barcodes().items():
+                if hit is None:
+                    continue
+                slot = self._slot(flocell, *hit)
+                if slot != -1:
+                    table[code] = slot
+            self._tables[flocell] = table
+        return self._tables[flocell]
+
+    def _slot(self, flocell, barcode, mismatches):
+        sample = self.sample_dict.get((flocell, self.lane, self.il_barcode, self.bc_dict[barcode]), None)
+        if sample is None:
+            return -1
+        if mismatches:
+            return self.slots[sample] + len(self.samples)
+        return self.slots[sample]
+
+    def n_slot(self, flocell, barcode):
+        """ The slot of a barcode that has N's (or other non ACGT bases).
+            These are not in the table, so they are compared to every known
+            barcode, counting an N as a mismatch. The results are cached.
+        """
+        if self.max_mismatches == 0:
+            return -1
+        key = (flocell, barcode)
+        if key not in self._n_slots:
+            distances = Counter()
+            best = (self.max_mismatches + 1, None)
+            for known in self.bc_dict:
+                if len(known) != self.bc_length:
+                    continue
+                mismatches = sum(1 for a, b in zip(barcode, known) if a != b)
+                distances[mismatches] += 1
+                best = min(best, (mismatches, known))
+            (mismatches, known) = best
+            if known is None or distances[mismatches] > 1:
+                self._n_slots[key] = -1
+            else:
+                self._n_slots[key] = self._slot(flocell, known, mismatches)
+        return self._n_slots[key]
+
+    def count(self, slot_counts, sample_counter):
+        """ Add the per-slot read counts to the sample counter """
+        n_samples = len(self.samples)
+        for slot, n in enumerate(slot_counts):
+            if n and slot < n_samples:
+                sample_counter[self.samples[slot]] += n
+            elif n:
+                sample_counter[self.samples[slot - n_samples]] += n
+                sample_counter[Corrected(self.samples[slot - n_samples])] += n
+
+def flocell_prefix(name):
+    """ The part of the read name up to and including the flowcell, and the flowcell """
+    fields = name.split(":", 3)
+    return ":".join(fields[:3]) + ":", fields[2]
+
+
+def open_readahead(r1_file, r2_file, chunk):
+    """ Start read-ahead threads for both files of a pair (or chunk) """
+    if chunk is None:
+        chunk = ((0, None), (0, None))
+    return [fastq_input.ReadAhead(fastq_input.open_fastq(filename, *file_range))
+            for filename, file_range in zip((r1_file, r2_file), chunk)]
+
+def log_readahead(r1_file, readers):
+    for reader in readers:
+        reader.close()
+    logger.info("%s : waited %.1f s for R1 reads, and %.1f s for R2 reads",
+                r1_file, readers[0].wait_time, readers[1].wait_time)
+
+def r2_filename(r1_file):
+    """ The name of the R2 file of a pair """
     assert ("_R1" in r1_file), "File name does not contain R1. Aborting"
     r2_file = r1_file.replace("_R1", "_R2")
     assert (r1_file != r2_file), "Couldn't find R2"
-    r2 = FastqReader(r2_file)
+    return r2_file
+
+def bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode, r1_file, umi_length, bc_length, cut_length, chunk=None, max_bc_mismatches=0, readahead=False):
+    """ Splits a fastq files according to barcode.
+        `chunk` is a pair of (start, end) offsets of R1 and R2 (see fastq_input.py)
+        With `readahead`, gzipped files are read by background threads.
+    """
+    sample_counter = Counter()
+    umibc = umi_length + bc_length
+    router = BarcodeRouter(bc_dict, sample_dict, lane, il_barcode, bc_length, max_bc_mismatches)
+    # corrected reads have their own slots, that go to the same files
+    handles = [files_dict[sample] for sample in router.samples] * 2
+    slot_counts = [0] * len(handles)
+    # the routing table is looked up only when the flowcell changes.
+    # No read name contains a newline, so the first read always looks it up.
+    prefix = "\n"
+    r2_file = r2_filename(r1_file)
+    readers = None
+    if readahead and r1_file.endswith("gz"):
+        readers = open_readahead(r1_file, r2_file, chunk)
+        r1 = FastqReader(readers[0].lines())
+        r2 = FastqReader(readers[1].lines())
+    elif chunk is None:
+        r1 = FastqReader(r1_file)
+        r2 = FastqReader(r2_file)
+    else:
+        (r1_range, r2_range) = chunk
+        r1 = FastqReader(fastq_input.RangeReader(r1_file, *r1_range))
+        r2 = FastqReader(fastq_input.RangeReader(r2_file, *r2_range))
     for n, (read1, read2) in enumerate(izip(r1,r2)):
 
         # validate reads are the same
@@ -151,9 +470,14 @@ def bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode,
             umi_end = umi_length
             bc_strt = umi_length
             bc_end = bc_length+umi_length
-            sample = get_sample(sample_dict, bc_dict, read1, lane, il_barcode, umi_strt, umi_end, bc_strt,bc_end)
-            if (sample is not None):
-                fh = files_dict[sample]
+            if not read1.name.startswith(prefix):
+                prefix, flocell = flocell_prefix(read1.name)
+                route = router.table(flocell)
+            barcode = read1.seq[bc_strt:bc_end]
+            code = encode_barcode(barcode)
+            slot = router.n_slot(flocell, barcode) if code is None else route[code]
+            if (slot != -1):
+                fh = handles[slot]
                 ### ADD UMIs to the read name
                 if umi_length == 0 :
                     name = read2.name
@@ -165,7 +489,7 @@ def bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode,
                 read = read2
                 read.write_to_fastq_file(fh)
 
-                sample_counter[sample] += 1
+                slot_counts[slot] += 1
             else:
                 bc = read1.seq[bc_strt:bc_end]
                 fh1 = files_dict['unknown_bc_R1']
@@ -176,8 +500,106 @@ def bc_split(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode,
                 sample_counter['undetermined'] += 1
         else:
             sample_counter['unqualified'] +=1
+    if readers is not None:
+        log_readahead(r1_file, readers)
+    router.count(slot_counts, sample_counter)
     return sample_counter
 
+
+def bc_split_raw(bc_dict, sample_dict, files_dict, min_bc_quality, lane, il_barcode, r1_file, umi_length, bc_length, cut_length, chunk=None, max_bc_mismatches=0, readahead=False):
+    """ Same as bc_split, but works on batches of raw FASTQ lines instead of
+        HTSeq objects. The output is byte-identical to that of bc_split,
+        including the "[part]" that HTSeq adds to the names of trimmed reads.
+    """
+    sample_counter = Counter()
+    umibc = umi_length + bc_length
+    bc_end = bc_length + umi_length
+    # compare quality characters instead of numbers
+    min_qual_char = chr(max(0, int(min_bc_quality) + 33))
+    router = BarcodeRouter(bc_dict, sample_dict, lane, il_barcode, bc_length, max_bc_mismatches)
+    # corrected reads have their own slots, that go to the same files
+    handles = [files_dict[sample] for sample in router.samples] * 2
+    slot_counts = [0] * len(handles)
+    # the routing table is looked up only when the flowcell changes
+    prefix = "\n"
+    base_digits = BASE_DIGITS
+    r2_file = r2_filename(r1_file)
+    if readahead and r1_file.endswith("gz"):
+        readers = open_readahead(r1_file, r2_file, chunk)
+    else:
+        if chunk is None:
+            chunk = ((0, None), (0, None))
+        (r1_range, r2_range) = chunk
+        readers = None
+        r1 = fastq_input.open_fastq(r1_file, *r1_range)
+        r2 = fastq_input.open_fastq(r2_file, *r2_range)
+    unknown_r1 = files_dict['unknown_bc_R1']
+    unknown_r2 = files_dict['unknown_bc_R2']
+    try:
+        if readers is not None:
+            batches = fastq_input.paired_batches(readers[0], readers[1])
+        else:
+            batches = fastq_input.paired_batches(fastq_input.record_batches(r1),
+                                                 fastq_input.record_batches(r2))
+        for lines1, lines2 in batches:
+            # the output of each batch is collected per file, and written at once
+            out = {}
+            for i in xrange(0, len(lines1), 4):
+                head1 = lines1[i]
+                head2 = lines2[i]
+
+                # validate reads are the same
+                assert (head1.split(None, 1)[0] == head2.split(None, 1)[0]), "Reads have different ids. Aborting."
+
+                # check minimal length and quality
+                qual1 = lines1[i+3]
+                if len(qual1) < umibc or min(qual1[:umibc]) < min_qual_char:
+                    sample_counter['unqualified'] += 1
+                    continue
+
+                ### trim read to cut_length
+                seq2 = lines2[i+1]
+                qual2 = lines2[i+3]
+                name2 = head2[1:]
+                if len(seq2) > cut_length:
+                    seq2 = seq2[:cut_length]
+                    qual2 = qual2[:cut_length]
+                    if not name2.endswith("[part]"):
+                        name2 += "[part]"
+
+                seq1 = lines1[i+1]
+                if not head1.startswith(prefix):
+                    prefix, flocell = flocell_prefix(head1)
+                    route = router.table(flocell)
+                barcode = seq1[umi_length:bc_end]
+                try:
+                    slot = route[int(barcode.translate(base_digits), 4)]
+                except ValueError:
+                    slot = router.n_slot(flocell, barcode)
+                if slot != -1:
+                    if umi_length != 0:
+                        name2 = name2.split()[0] + ':UMI:%s:' % seq1[:umi_length]
+                    out.setdefault(handles[slot], []).append("@%s\n%s\n+\n%s\n" % (name2, seq2, qual2))
+                    slot_counts[slot] += 1
+                else:
+                    out.setdefault(unknown_r1, []).append("%s\n%s\n+\n%s\n" % (head1, seq1, qual1))
+                    out.setdefault(unknown_r2, []).append("@%s\n%s\n+\n%s\n" % (name2, seq2, qual2))
+                    sample_counter['undetermined'] += 1
+            for fh, records in out.iteritems():
+                fh.write("".join(records))
+    finally:
+        if readers is not None:
+            log_readahead(r1_file, readers)
+        else:
+            r1.close()
+            r2.close()
+    router.count(slot_counts, sample_counter)
+    return sample_counter
+
+
+# the splitting engines, by name
+SPLITTERS = {"htseq": bc_split, "raw": bc_split_raw}
+
                 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description= __doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -187,10 +609,33 @@ if __name__ == "__main__":
                         help='Output directory. Defaults to current directory')
     parser.add_argument('--stats-file', metavar='STATFILE', type=str, default='stats.tab',
                         help='Statistics file name (default: stats.tab)')
+    parser.add_argument('--procs', metavar='N', type=int, default=1,
+                        help='Number of file pairs to split in parallel (default=1)')
+    parser.add_argument('--chunks', metavar='N', type=int, default=1,
+                        help='Split each uncompressed or BGZF file pair into N chunks, '
+                             'which are split in parallel (default=1)')
+    parser.add_argument('--engine', choices=sorted(SPLITTERS), default='htseq',
+                        help='Splitting engine (default: htseq)')
+    parser.add_argument('--max-bc-mismatches', metavar='N', type=int, default=0,
+                        help='Correct barcodes with up to N mismatches (default=0)')
+    parser.add_argument('--compression', choices=fastq_output.COMPRESSIONS, default='none',
+                        help='Compression of the output files (default: none)')
+    parser.add_argument('--compression-level', metavar='N', type=int, default=6,
+                        help='gzip compression level (default=6)')
+    parser.add_argument('--compression-threads', metavar='N', type=int, default=1,
+                        help='Number of compression threads (default=1)')
+    parser.add_argument('--container', metavar='FILENAME', type=str, default='',
+                        help='Write all samples into this container file, in the output directory')
+    parser.add_argument('--readahead', action='store_true', default=False,
+                        help='Decompress gzipped input files in background threads')
     parser.add_argument('bc_index', type=str)
     parser.add_argument('sample_sheet', type=str)
     parser.add_argument('fastq_files', type=str, nargs='+')
     args = parser.parse_args()
     main(args.bc_index, args.sample_sheet, args.fastq_files, stats_file=args.stats_file,
-         output_dir=args.out_dir, min_bc_quality=args.min_bc_quality)
+         output_dir=args.out_dir, min_bc_quality=args.min_bc_quality, procs=args.procs, chunks=args.chunks,
+         engine=args.engine, max_bc_mismatches=args.max_bc_mismatches,
+         output_compression=args.compression, compression_level=args.compression_level,
+         compression_threads=args.compression_threads, output_container=args.container,
+         readahead=args.readahead)
 
@@ -1,70 +1,481 @@
 #!/usr/bin/python2
 """ run bowtie with specified parameter file 
+
+An input file can also be a container of samples written by bc_demultiplex
+(see fastq_container.py). Each sample in it, except the undetermined reads, is
+streamed into bowtie2's stdin.
+
+If an input file was collapsed by collapse_reads, its SAM file is expanded back
+after the alignment, and the report counts the original reads.
+
+With `batched`, all the samples are streamed into a single bowtie2 process, so
+the index is loaded only once. The sample number is put in front of each read
+name ("<n>#<name>"), and the SAM output is split into the per-sample SAM files
+by that tag. The per-sample stats are then counted from the SAM flags, the same
+way bowtie2 counts them (a read with an XS tag aligned more than once).
+
+Otherwise, the samples are aligned by separate bowtie2 jobs, scheduled within
+a budget of `cores` (default: all of them) and `memory` (in GB, default: no
+limit). At most `procs` jobs run at once, each with at least `number_of_threads`
+threads. The largest inputs are started first, and a job gets more threads
+when fewer jobs remain than could run, so the end of the run is not one large
+sample on a few threads. With `mm` (off by default), bowtie2 memory-maps the
+index (--mm), so the jobs share the pages of one copy of the index.
+
+bowtie2's stderr is read while it runs. Only its last lines (the summary) are
+kept, and warnings are counted by kind ("Warning: skipping read '*' because
+it was < N characters long"), with the read name and numbers left out. The
+report has a column for every kind of warning.
 """
 
+import sys
+import re
+import gzip
+import threading
+import multiprocessing
 import subprocess
 from logging import getLogger
 import os
 import shlex
 import argparse
 import csv
-from glob import glob
-from multiprocessing.pool import ThreadPool
+from collections import Counter, deque
+
+import fastq_container
+import collapse_reads
+import checkpoint
+from fastq_input import fastq_base_name
 
 logger = getLogger('pijp.bowtie_wrapper')
 
-def build_bowtie_command(fastq_file,  index_file, number_of_threads, output_dir, extra_params):
-    base_fastq = os.path.splitext(os.path.basename(fastq_file))[0]
-    samfile = os.path.join(output_dir, base_fastq + ".sam")
+# a rough guess of the memory of a bowtie2 job, besides the index
+JOB_MEMORY = 256 * 1024 * 1024
+
+# the number of non-warning stderr lines that are kept, for the summary and errors
+STDERR_TAIL = 20
+READ_NAME = re.compile(r"'[^']*'")
+NUMBER = re.compile(r"[0-9]+")
+BATCH_TAG = re.compile(r"'([0-9]+)#")
+# the SAM flags of secondary and supplementary alignments
+NOT_PRIMARY = 0x100 | 0x800
+
+def expand_input(input_file):
+    """ List the (name, fastq_file, stream_cmd) of an input file. For a plain
+        FASTQ file, stream_cmd is None. For a container, there is one entry
+        per sample, and stream_cmd writes the sample to stdout.
+    """
+    if not fastq_container.is_container(input_file):
+        return [(input_file, input_file, None)]
+    script = os.path.join(os.path.dirname(os.path.abspath(fastq_container.__file__)), "fastq_container.py")
+    entries = []
+    for sample in sorted(fastq_container.sample_names(input_file)):
+        if sample.startswith("undetermined_"):
+            continue
+        stream_cmd = " ".join([sys.executable, script, input_file, sample])
+        entries.append(("{0}:{1}".format(input_file, sample), sample, stream_cmd))
+    return entries
+
+def input_sizes(input_file):
+    """ The size of each (fastq_file) entry of an input file, for ordering the jobs """
+    if not fastq_container.is_container(input_file):
+        return {input_file: os.path.getsize(input_file)}
+    return fastq_container.sample_sizes(input_file)
+
+def index_size(index_file):
+    """ The size of the bowtie2 index files, in bytes """
+    return sum(os.path.getsize(f) for f in checkpoint.index_files(index_file))
+
+def max_parallel_jobs(cores, memory, procs, min_threads, index_bytes, mm):
+    """ The number of jobs that fit into the core and memory budgets, and procs """
+    jobs = min(procs, max(1, cores // min_threads))
+    if memory > 0:
+        if mm:
+            # the index pages are shared by all the jobs
+            memory_jobs = (memory - index_bytes) // JOB_MEMORY
+        else:
+            memory_jobs = memory // (index_bytes + JOB_MEMORY)
+        if memory_jobs < 1:
+            logger.warning("The memory budget is too small for a single bowtie2 job, running one anyway")
+        jobs = min(jobs, max(1, memory_jobs))
+    return jobs
+
+def run_scheduled(jobs, make_cmd, cores, max_jobs, min_threads, run=None):
+    """ Run the jobs, the largest first, and return their results in the original order.
+        `jobs` is a list of (size, name, expand), and make_cmd(i, threads)
+        returns the command of job i. Each job is run by run((cmd, name, expand)),
+        run_cmd by default.
+        Whenever cores are free, the next job is started with its share of the
+        free cores: free cores / the number of jobs that could still start.
+    """
+    run = run or run_cmd
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i][0], reverse=True)
+    results = [None] * len(jobs)
+    errors = []
+    state = {'free': cores, 'running': 0}
+    done = threading.Condition()
+
+    def run_job(i, threads):
+        try:
+            size, name, expand = jobs[i]
+            results[i] = run((make_cmd(i, threads), name, expand))
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            with done:
+                state['free'] += threads
+                state['running'] -= 1
+                done.notify()
+
+    workers = []
+    with done:
+        while pending and not errors:
+            while state['running'] and (state['running'] >= max_jobs or state['free'] < min_threads):
+                done.wait()
+            if errors:
+                break
+            slots = min(max_jobs - state['running'], len(pending))
+            threads = max(min_threads, state['free'] // slots)
+            i = pending.pop(0)
+            logger.info("starting %s with %d threads (%d of %d cores were free)",
+                        jobs[i][1], threads, state['free'], cores)
+            state['free'] -= threads
+            state['running'] += 1
+            worker = threading.Thread(target=run_job, args=(i, threads))
+            worker.start()
+            workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def sam_filename(fastq_file, output_dir):
+    return os.path.join(output_dir, fastq_base_name(fastq_file) + ".sam")
+
+def build_bowtie_command(fastq_file,  index_file, number_of_threads, output_dir, extra_params, stream_cmd=None):
+    """ The bowtie2 command of one sample. With output_dir None, the SAM goes to stdout. """
+    sam_option = "" if output_dir is None else "-S " + sam_filename(fastq_file, output_dir)
 
     ##  no-hd means no header lines. 
     ##  -p is for the number of rows.
-    bowtie_cmd = "bowtie2  -p {0} {1} -x {2} -U {3} -S {4} ".format(number_of_threads, extra_params, index_file, fastq_file, samfile)
+    if stream_cmd is None:
+        bowtie_cmd = "bowtie2  -p {0} {1} -x {2} -U {3} {4} ".format(number_of_threads, extra_params, index_file, fastq_file, sam_option)
+    else:
+        bowtie_cmd = "{5} | bowtie2  -p {0} {1} -x {2} -U - {4} ".format(number_of_threads, extra_params, index_file, fastq_file, sam_option, stream_cmd)
     return bowtie_cmd
 
-def run_cmd((cmd,fastq_file)):
-    """  Run the command, and return the stderr. 
+def warning_kind(line):
+    """ The warning without the read name and numbers """
+    return NUMBER.sub("N", READ_NAME.sub("'*'", line.strip()))
+
+def warning_reads(line, table):
+    """ The number of reads a warning is about: the reads of the collapsed read
+        that it names, in the collapse `table` (see collapse_reads.read_table),
+        or 1.
+    """
+    name = READ_NAME.search(line)
+    if table is None or name is None:
+        return 1
+    # without the sample number of batched mode
+    read_id = name.group(0)[1:-1].split("#")[-1]
+    return table[read_id][0] if read_id in table else 1
+
+def read_stderr(stderr_lines, warnings, batched=False, tables=None):
+    """ Consume bowtie2's stderr. Warnings are counted in the `warnings` Counter,
+        by kind, or by (sample number, kind) if `batched`.
+        For collapsed input, a warning counts the original reads: `tables` is
+        the collapse table, or if `batched` the list of the samples' tables
+        (None for a sample that is not collapsed).
+        Returns the last STDERR_TAIL other lines.
+    """
+    tail = deque(maxlen=STDERR_TAIL)
+    for line in stderr_lines:
+        if not line.startswith("Warning"):
+            tail.append(line)
+            continue
+        kind = warning_kind(line)
+        table = tables
+        if batched:
+            tag = BATCH_TAG.search(line)
+            kind = (int(tag.group(1)) if tag else None, kind)
+            table = tables[kind[0]] if tables is not None and kind[0] is not None else None
+        warnings[kind] += warning_reads(line, table)
+    return list(tail)
+
+def log_warnings(fastq_file, warnings):
+    for kind, count in sorted(warnings.items()):
+        logger.info("BOWTIE %s : %d x %s", fastq_file, count, kind)
+
+def run_cmd((cmd,fastq_file,expand)):
+    """  Run the command, and return the report row and the warnings.
+         `expand` is (samfile, collapse table) for collapsed input, or None.
     """
     logger.info("ran  : " + cmd)
+    table = collapse_reads.read_table(expand[1]) if expand is not None else None
     pro = subprocess.Popen(cmd, shell=True, stderr = subprocess.PIPE)
-    (x, stderr) = pro.communicate()
-    assert (pro.returncode == 0 ), "bowtie error %d : %s" % (pro.returncode, stderr)
-    new_row = ( [fastq_file] + get_stats(stderr.splitlines()) )
+    warnings = Counter()
+    stderr = read_stderr(pro.stderr, warnings, tables=table)
+    pro.wait()
+    assert (pro.returncode == 0 ), "bowtie error %d : %s" % (pro.returncode, "".join(stderr))
+    log_warnings(fastq_file, warnings)
+    if expand is None:
+        new_row = ( [fastq_file] + get_stats(stderr) )
+    else:
+        logger.info("expanding collapsed reads of %s", expand[0])
+        new_row = ( [fastq_file] + expand_sam_file(expand[0], table) )
     logger.info("finished  : " + cmd)
-    return new_row
+    return new_row, warnings
 
-def main(input_files, index_file, number_of_threads, output_dir, bowtie_report_name,extra_params,procs=10):
-    report = []
-    ht_col2 = []
+def count_alignment(stats, rest, reads=1):
+    """ Count a SAM line (without its QNAME) as bowtie2 does in its summary.
+        Secondary and supplementary alignments (with -k or -a) are not reads.
+    """
+    flag = int(rest.split("\t", 1)[0])
+    if flag & NOT_PRIMARY:
+        return
+    stats['total'] += reads
+    if flag & 4:
+        stats['not_aligned'] += reads
+    elif "\tXS:i:" in rest:
+        stats['multi_aligned'] += reads
+    else:
+        stats['aligned_once'] += reads
+
+def format_sam_stats(stats):
+    """ [total, not_aligned, aligned_once, multi_aligned, % mapped], as get_stats returns them """
+    total = stats['total']
+    if total == 0:
+        return ['0', '0', '0', '0', '0']
+    mapped = 100.0 * (stats['aligned_once'] + stats['multi_aligned']) / total
+    return [str(total), str(stats['not_aligned']), str(stats['aligned_once']),
+            str(stats['multi_aligned']), "%.2f%%" % mapped]
+
+def expand_sam_file(sam_file, table):
+    """ Expand the SAM file of collapsed reads in place, with their collapse table.
+        Returns the stats of the original reads.
+    """
+    stats = Counter()
+    on_alignment = lambda rest, reads: count_alignment(stats, rest, reads)
+    tmp_file = sam_file + ".expanding"
+    with open(sam_file, "rb") as in_fh:
+        with open(tmp_file, "wb") as out_fh:
+            out_fh.writelines(collapse_reads.expand_sam(in_fh, table, on_alignment))
+    os.rename(tmp_file, sam_file)
+    return format_sam_stats(stats)
+
+def _feed_samples(stdin, entries, errors):
+    """ Write the reads of all samples, tagged with the sample number, to bowtie2's stdin.
+        An error is added to `errors`, for the main thread to raise.
+    """
+    try:
+        for n, (name, fastq_file, stream_cmd, expand) in enumerate(entries):
+            tag = "@%d#" % n
+            if stream_cmd is not None:
+                source = subprocess.Popen(stream_cmd, shell=True, stdout=subprocess.PIPE)
+                lines = source.stdout
+            elif fastq_file.endswith("gz"):
+                lines = gzip.open(fastq_file, "rb")
+            else:
+                lines = open(fastq_file, "rb")
+            for i, line in enumerate(lines):
+                if i % 4 == 0:
+                    line = tag + line[1:]
+                stdin.write(line)
+            lines.close()
+            if stream_cmd is not None:
+                assert (source.wait() == 0), "Error streaming %s" % name
+    except Exception:
+        errors.append(sys.exc_info())
+    finally:
+        stdin.close()
+
+def run_batched(entries, index_file, number_of_threads, output_dir, extra_params):
+    """ Align all the samples with one bowtie2 process, and split the output.
+        Returns the report rows.
+    """
+    cmd = "bowtie2  -p {0} {1} -x {2} -U - ".format(number_of_threads, extra_params, index_file)
+    logger.info("ran  : " + cmd)
+    pro = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, bufsize=-1)
+    feed_errors = []
+    feeder = threading.Thread(target=_feed_samples, args=(pro.stdin, entries, feed_errors))
+    feeder.start()
+    stderr = []
+    warnings = Counter()
+    # the warnings of collapsed reads are counted as the reads they stand for
+    tables = [collapse_reads.read_table(expand[1]) if expand is not None else None
+              for (name, fastq_file, stream_cmd, expand) in entries]
+    stderr_reader = threading.Thread(target=lambda: stderr.extend(read_stderr(pro.stderr, warnings, True, tables)))
+    stderr_reader.start()
+
+    headers = []
+    sam_files = None
+    stats = [Counter() for entry in entries]
+    def open_sam_files():
+        # bowtie2 writes all the header lines first
+        files = [open(sam_filename(fastq_file, output_dir), "wb")
+                 for (name, fastq_file, stream_cmd, expand) in entries]
+        for sam_fh in files:
+            sam_fh.writelines(headers)
+        return files
+    try:
+        for line in pro.stdout:
+            if line.startswith("@"):
+                headers.append(line)
+                continue
+            if sam_files is None:
+                sam_files = open_sam_files()
+            tag, line = line.split("#", 1)
+            n = int(tag)
+            expand = entries[n][3]
+            if expand is None:
+                count_alignment(stats[n], line.split("\t", 1)[1])
+                sam_files[n].write(line)
+            else:
+                on_alignment = lambda rest, reads: count_alignment(stats[n], rest, reads)
+                sam_files[n].writelines(collapse_reads.expand_sam([line], tables[n], on_alignment))
+        if sam_files is None:
+            # no reads at all, but every sample gets its (header only) SAM file
+            sam_files = open_sam_files()
+    except:
+        # nothing reads bowtie2's output any more, so the feeder could block on its input
+        pro.kill()
+        pro.stdout.close()
+        raise
+    finally:
+        feeder.join()
+        stderr_reader.join()
+        pro.wait()
+        for sam_fh in sam_files or []:
+            sam_fh.close()
+    if feed_errors:
+        # bowtie2 got truncated input, so its output is incomplete
+        raise feed_errors[0][0], feed_errors[0][1], feed_errors[0][2]
+    assert (pro.returncode == 0 ), "bowtie error %d : %s" % (pro.returncode, "".join(stderr))
+    logger.info("BOWTIE summary of all samples : " + " | ".join(line.strip() for line in stderr[-6:]))
+    logger.info("finished  : " + cmd)
+    sample_warnings = [Counter() for entry in entries]
+    for (n, kind), count in warnings.items():
+        if n is None:
+            logger.info("BOWTIE : %d x %s", count, kind)
+        else:
+            sample_warnings[n][kind] += count
+    results = []
+    for (name, fastq_file, stream_cmd, expand), sample_stats, warnings in zip(entries, stats, sample_warnings):
+        log_warnings(name, warnings)
+        results.append(([name] + format_sam_stats(sample_stats), warnings))
+    return results
+
+def list_jobs(input_files, output_dir):
+    """ Returns the base names, the (size, name, expand) jobs for run_scheduled,
+        and the (name, fastq_file, stream_cmd, expand) entries of all the samples.
+    """
     base_names = []
-    cmds = []
-    for fastq_file in input_files:
-       base_names += [os.path.splitext(os.path.basename(fastq_file))[0]]
-       #  we need base_names for heading the matrix file.
-       bt2_cmd = build_bowtie_command(fastq_file, index_file, number_of_threads, output_dir, extra_params)       
-       cmds.append((bt2_cmd,fastq_file))
-    ht_col1 = "\n".join(base_names)
-    pool = ThreadPool(int(procs))
-    results = pool.map(run_cmd, cmds)
-    for res in results:
-        htout = "\t".join(res)
+    jobs = []
+    entries = []
+    for input_file in input_files:
+        sizes = input_sizes(input_file)
+        for (name, fastq_file, stream_cmd) in expand_input(input_file):
+            base_names += [fastq_base_name(fastq_file)]
+            #  we need base_names for heading the matrix file.
+            table = collapse_reads.collapsed_table(fastq_file) if stream_cmd is None else None
+            expand = None
+            if table is not None:
+                expand = (sam_filename(fastq_file, output_dir), table)
+            jobs.append((sizes.get(fastq_file, 0), name, expand))
+            entries.append((name, fastq_file, stream_cmd, expand))
+    return base_names, jobs, entries
+
+def mm_params(extra_params, mm):
+    """ Add --mm to the bowtie2 parameters, if asked to """
+    if str(mm).lower() in ["true", "yes", "1"] and "--mm" not in extra_params.split():
+        extra_params = (extra_params + " --mm").strip()
+    return extra_params
+
+def alignment_budget(cores, memory, procs, number_of_threads, index_file, extra_params):
+    """ Returns (cores, max_jobs, min_threads) for run_scheduled """
+    cores = int(cores or 0) or multiprocessing.cpu_count()
+    min_threads = int(number_of_threads)
+    memory = int(float(memory or 0) * 1024 ** 3)
+    mm = "--mm" in extra_params.split()
+    max_jobs = max_parallel_jobs(cores, memory, int(procs), min_threads, index_size(index_file), mm)
+    return cores, max_jobs, min_threads
+
+def write_report(results, filename):
+    """ Write the report of the (row, warnings) results """
+    ht_col2 = []
+    # a column for every kind of warning that any sample had
+    warning_kinds = sorted(set(kind for res, warnings in results for kind in warnings))
+    for res, warnings in results:
+        htout = "\t".join(res + [str(warnings[kind]) for kind in warning_kinds])
         ht_col2.append(htout)
-    matrix_header = "\t".join(['#sample','total', 'not_aligned', 'aligned_once', 'multi_aligned', '% mapped']) + "\n"
+    matrix_header = "\t".join(['#sample','total', 'not_aligned', 'aligned_once', 'multi_aligned', '% mapped'] +
+                              warning_kinds) + "\n"
     matrix = "\n".join(ht_col2)
-    filename = os.path.join(output_dir, bowtie_report_name)
     with open(filename, 'wb') as f:
         f.write(matrix_header)
         f.write(matrix)
 
+def unit_inputs((name, fastq_file, stream_cmd, expand)):
+    """ The files a sample is aligned from """
+    if stream_cmd is not None:
+        # a sample of a container, named "container:sample"
+        return [name[:-len(fastq_file) - 1]]
+    return [fastq_file] + ([expand[1]] if expand is not None else [])
+
+def main(input_files, index_file, number_of_threads, output_dir, bowtie_report_name,extra_params,procs=10,
+         batched="false", cores=0, memory=0, mm="false", units=None, executor=None):
+    """ Align every sample. `units` (a checkpoint.Units) keeps the samples that
+        were aligned, so they are not aligned again on resume (not in batched mode).
+        With an `executor` (see executors.py), each sample is run by it with
+        number_of_threads threads, instead of by the local scheduler.
+    """
+    base_names, jobs, entries = list_jobs(input_files, output_dir)
+    extra_params = mm_params(extra_params, mm)
+    if str(batched).lower() in ["true", "yes", "1"]:
+        # one process gets all the cores.
+        cores = int(cores or 0) or multiprocessing.cpu_count()
+        results = run_batched(entries, index_file, cores, output_dir, extra_params)
+    else:
+        results = [None] * len(jobs)
+        unit_params = [index_file, extra_params]
+        # a sample is aligned again if the index changed
+        unit_files = lambda i: unit_inputs(entries[i]) + checkpoint.index_files(index_file)
+        unit_outputs = lambda i: [sam_filename(entries[i][1], output_dir)]
+        if units is not None:
+            for i, entry in enumerate(entries):
+                saved = units.done(entry[0], unit_files(i), unit_outputs(i), unit_params)
+                if saved is not None:
+                    results[i] = ([str(value) for value in saved[0]], Counter(dict((str(kind), count) for kind, count in saved[1].items())))
+        todo = [i for i in range(len(jobs)) if results[i] is None]
+        make_cmd = lambda k, threads: build_bowtie_command(entries[todo[k]][1], index_file, threads, output_dir,
+                                                           extra_params, entries[todo[k]][2])
+        entry_numbers = dict((entries[i][0], i) for i in todo)
+        def record(job, result):
+            i = entry_numbers[job[1]]
+            if units is not None:
+                units.record(entries[i][0], unit_files(i), unit_outputs(i), unit_params,
+                             [result[0], dict(result[1])])
+            return result
+        if executor is not None:
+            threads = int(number_of_threads)
+            logger.info("aligning %d samples with %s", len(todo), type(executor).__name__)
+            todo_jobs = [(make_cmd(k, threads), jobs[i][1], jobs[i][2]) for k, i in enumerate(todo)]
+            todo_results = [record(job, result) for job, result in
+                            zip(todo_jobs, executor.map(run_cmd, todo_jobs, threads))]
+        else:
+            cores, max_jobs, min_threads = alignment_budget(cores, memory, procs, number_of_threads,
+                                                            index_file, extra_params)
+            logger.info("aligning %d samples, up to %d at once, on %d cores", len(todo), max_jobs, cores)
+            run = lambda job: record(job, run_cmd(job))
+            todo_results = run_scheduled([jobs[i] for i in todo], make_cmd, cores, max_jobs, min_threads, run)
+        for i, result in zip(todo, todo_results):
+            results[i] = result
+    write_report(results, os.path.join(output_dir, bowtie_report_name))
+
 def get_stats(bt_stderr):
-    ## Write all warnings to log, and skip them.
-    # For millions of warnings this takes too long..
-    #while bt_stderr[0].startswith("Warning"):
-    #    logger.info("BOWTIE : " + bt_stderr[0])
-    #    bt_stderr.pop(0)
-    if len(bt_stderr)  > 5:
-        logger.info("Bowtie probably had {0} warnings [e.g. read too small]".format(len(bt_stderr)-4))
-        bt_stderr = bt_stderr[-5:]
+    ## bt_stderr are the last lines of the stderr, without the warnings (see read_stderr).
+    bt_stderr = bt_stderr[-5:]
     if int(bt_stderr[0].split()[0]) != 0 :
         total = str(int(bt_stderr[0].split()[0]))
         not_aligned = str(int(bt_stderr[1].split()[0]))
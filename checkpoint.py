@@ -0,0 +1,165 @@
+#!/usr/bin/python2
+""" The manifest of the pipe segments that finished, for rerunning the pipeline.
+
+pijpleiding keeps a manifest (MANIFEST_FILE) in the output directory of every
+section. For each section that finished, it has the parameters, and the size
+and modification time of the files it read (the input files, and the files
+that other parameters name, e.g. the GFF file or the bowtie2 index) and of the
+files the section wrote (the output). With --resume, a section whose parameters, inputs and outputs
+did not change since is skipped.
+
+A segment can also keep its own units of work (e.g. the alignment of one
+sample), with `Units`. A unit is recorded as soon as it is done, with its
+inputs, outputs, parameters and result, so after a crash only the units that
+did not finish are run again. The segment gets its Units as the `units`
+argument (see pijpleiding.py).
+"""
+
+from __future__ import print_function, division
+
+import os
+import json
+import tempfile
+import threading
+from glob import glob
+from logging import getLogger
+
+logger = getLogger('pijp.checkpoint')
+
+MANIFEST_FILE = "pijp_manifest.json"
+# files in the output directory that are not outputs
+IGNORED = ("pijp.log", MANIFEST_FILE)
+
+
+def file_state(filename):
+    """ [size, modification time] of a file, or None if there is no such file """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def files_state(filenames):
+    return dict((filename, file_state(filename)) for filename in filenames)
+
+
+def parameter_files(parameters):
+    """ The files that a section reads: its input files, the other parameters
+        that name a file (e.g. gff_file), and the files of a bowtie2 index
+        (index_file is the prefix of their names)
+    """
+    files = list(parameters["input_files"])
+    for key, value in sorted(parameters.items()):
+        if key == "input_files" or not isinstance(value, basestring) or not value:
+            continue
+        if os.path.isfile(value):
+            files.append(value)
+        else:
+            files += index_files(value)
+    return files
+
+
+def index_files(index_file):
+    """ The files of a bowtie2 index """
+    return sorted(glob(index_file + ".*.bt2") + glob(index_file + ".*.bt2l"))
+
+
+def dir_state(dirname):
+    """ The state of all the files under a directory """
+    state = dict()
+    for root, dirs, files in os.walk(dirname):
+        for name in files:
+            if root == dirname and (name in IGNORED or name.startswith(MANIFEST_FILE)):
+                continue
+            filename = os.path.join(root, name)
+            state[filename] = file_state(filename)
+    return state
+
+
+def json_copy(value):
+    """ The value as it is after it is saved and loaded, for comparing """
+    return json.loads(json.dumps(value))
+
+
+class Manifest(object):
+    """ The manifest of an output directory """
+
+    def __init__(self, output_dir, resume=False):
+        self.output_dir = output_dir
+        self.resume = resume
+        self.filename = os.path.join(output_dir, MANIFEST_FILE)
+        self.lock = threading.RLock()
+        self.data = {"sections": {}, "units": {}}
+        if os.path.exists(self.filename):
+            with open(self.filename) as fh:
+                self.data = json.load(fh)
+
+    def save(self):
+        with self.lock:
+            fd, tmp_file = tempfile.mkstemp(dir=self.output_dir, prefix=MANIFEST_FILE)
+            with os.fdopen(fd, "w") as fh:
+                json.dump(self.data, fh, indent=1, sort_keys=True)
+            os.rename(tmp_file, self.filename)
+
+    def section_done(self, section, parameters):
+        """ Whether the section finished with these parameters, and its inputs
+            and outputs did not change since
+        """
+        entry = self.data["sections"].get(section)
+        if not self.resume or entry is None:
+            return False
+        return (entry["parameters"] == json_copy(parameters) and
+                entry["inputs"] == json_copy(files_state(parameter_files(parameters))) and
+                all(file_state(filename) == state for filename, state in entry["outputs"].iteritems()))
+
+    def start_section(self, section):
+        """ Forget that the section finished. Returns the state of the output
+            directory, for finish_section.
+        """
+        self.data["sections"].pop(section, None)
+        self.save()
+        return dir_state(self.output_dir)
+
+    def finish_section(self, section, parameters, before):
+        """ Record the section, with the files that changed since start_section as its outputs """
+        outputs = dict((filename, state) for filename, state in dir_state(self.output_dir).iteritems()
+                       if before.get(filename) != state)
+        self.data["sections"][section] = {"parameters": parameters,
+                                          "inputs": files_state(parameter_files(parameters)),
+                                          "outputs": outputs}
+        self.save()
+
+    def units(self, section):
+        return Units(self, section)
+
+
+class Units(object):
+    """ The finished units of work of a section, each with a name """
+
+    def __init__(self, manifest, section):
+        self.manifest = manifest
+        self.entries = manifest.data["units"].setdefault(section, dict())
+
+    def done(self, name, inputs, outputs, params):
+        """ The result of a unit that finished with the same inputs, outputs and
+            params (on resume), or None
+        """
+        entry = self.entries.get(name)
+        if not self.manifest.resume or entry is None:
+            return None
+        if (entry["params"] == json_copy(params) and
+                entry["inputs"] == json_copy(files_state(inputs)) and
+                entry["outputs"] == json_copy(files_state(outputs)) and None not in entry["outputs"].values()):
+            logger.info("%s finished before, skipping it", name)
+            return entry["result"]
+        return None
+
+    def record(self, name, inputs, outputs, params, result):
+        """ Record a unit that finished. result must be saveable as json """
+        entry = {"inputs": files_state(inputs), "outputs": files_state(outputs),
+                 "params": params, "result": result}
+        # units may finish in several threads at once
+        with self.manifest.lock:
+            self.entries[name] = entry
+            self.manifest.save()
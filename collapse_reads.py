@@ -0,0 +1,172 @@
+#!/usr/bin/python2
+""" Collapse identical reads of each sample before the alignment.
+
+CEL-Seq libraries have many PCR duplicates, so many (trimmed) reads of a sample
+have the same sequence. This segment writes every distinct sequence of a sample
+only once, named "u<n>", together with a table (X.collapsed.tab next to X.fastq)
+of the number of reads, and the UMIs, of each distinct sequence.
+
+bowtie_wrapper aligns the distinct sequences only. When it finds the table of a
+FASTQ file, it expands the SAM file back: every alignment line is written once
+per original read, named "u<n>.<k>:UMI:<umi>:", so htseq_count_umified counts
+the same reads and UMIs as without collapsing. The table records the name and
+size of its FASTQ file, and is ignored next to any other FASTQ file.
+
+All the reads of a distinct sequence get the one alignment of that sequence.
+Without collapsing, they are aligned one by one, and may not all align the
+same way:
+
+  - bowtie2 seeds its random choices (e.g. among equally good alignments of a
+    multi-mapped read) from the read's name, sequence and qualities, and the
+    reads are renamed. Collapsed copies share one choice.
+  - The collapsed read gets the qualities of the first read with that
+    sequence, and bowtie2 uses qualities in scoring. With `use_quality`, only
+    reads with the same sequence and the same qualities are collapsed.
+
+So the counts are those of a run in which identical reads align identically.
+They can differ slightly from a run without collapsing, mostly for
+multi-mapped reads.
+"""
+
+from __future__ import print_function, division
+
+import os
+import gzip
+import csv
+from logging import getLogger
+from collections import OrderedDict, Counter
+from multiprocessing import Pool
+
+from fastq_input import fastq_base_name
+
+logger = getLogger('pijp.collapse_reads')
+
+TABLE_SUFFIX = ".collapsed.tab"
+
+
+def table_filename(fastq_file):
+    """ The collapse table that belongs to a (collapsed) FASTQ file """
+    return os.path.join(os.path.dirname(fastq_file), fastq_base_name(fastq_file) + TABLE_SUFFIX)
+
+
+def fastq_row(fastq_file):
+    """ The first row of a collapse table: the name and size of its FASTQ file """
+    return ["#fastq", os.path.basename(fastq_file), str(os.path.getsize(fastq_file))]
+
+
+def collapsed_table(fastq_file):
+    """ The collapse table of a FASTQ file, or None if it was not collapsed.
+        A table of another version of the file (e.g. a FASTQ file that was
+        written again, without collapsing) is ignored.
+    """
+    table_file = table_filename(fastq_file)
+    if not os.path.exists(table_file):
+        return None
+    with open(table_file, "rb") as fh:
+        first_row = next(csv.reader(fh, delimiter='\t'), None)
+    if first_row != fastq_row(fastq_file):
+        logger.warning("ignoring %s, it is not the collapse table of %s", table_file, fastq_file)
+        return None
+    return table_file
+
+
+def read_umi(name):
+    """ The UMI that bc_demultiplex added to the read name, or "" """
+    name = name.split()[0]
+    pos = name.rfind(":UMI:")
+    if pos == -1:
+        return ""
+    return name[pos + len(":UMI:"):-1]
+
+
+def collapse_file((fastq_file, output_dir, use_quality)):
+    """ Collapse one sample. Returns (reads, distinct sequences) """
+    logger.info("collapsing %s", fastq_file)
+    opener = gzip.open if fastq_file.endswith("gz") else open
+    # key -> [qualities, Counter of UMIs]
+    collapsed = OrderedDict()
+    reads = 0
+    with opener(fastq_file, "rb") as fh:
+        for name in fh:
+            seq = next(fh).rstrip("\n")
+            next(fh)
+            qual = next(fh).rstrip("\n")
+            key = (seq, qual) if use_quality else seq
+            entry = collapsed.get(key)
+            if entry is None:
+                entry = collapsed[key] = [qual, Counter()]
+            entry[1][read_umi(name[1:])] += 1
+            reads += 1
+
+    base_name = fastq_base_name(fastq_file)
+    collapsed_file = os.path.join(output_dir, base_name + ".fastq")
+    with open(collapsed_file, "wb") as out_fh:
+        for n, (key, (qual, umis)) in enumerate(collapsed.iteritems()):
+            seq = key[0] if use_quality else key
+            out_fh.write("@u%d\n%s\n+\n%s\n" % (n, seq, qual))
+    with open(table_filename(collapsed_file), "wb") as table_fh:
+        table_writer = csv.writer(table_fh, delimiter='\t')
+        # the table is only used with this FASTQ file (see collapsed_table)
+        table_writer.writerow(fastq_row(collapsed_file))
+        table_writer.writerow(["#id", "reads", "umis"])
+        for n, (key, (qual, umis)) in enumerate(collapsed.iteritems()):
+            umi_list = ",".join("%s:%d" % (umi, count) for umi, count in sorted(umis.items()) if umi)
+            table_writer.writerow(["u%d" % n, sum(umis.values()), umi_list])
+    logger.info("%s : %d reads, %d distinct", fastq_file, reads, len(collapsed))
+    return (reads, len(collapsed))
+
+
+def read_table(table_file):
+    """ Map each collapsed read id to (reads, [(umi, count), ...]) """
+    table = dict()
+    with open(table_file, "rb") as fh:
+        for row in csv.reader(fh, delimiter='\t'):
+            if row[0].startswith("#"):
+                continue
+            umis = []
+            if row[2]:
+                for item in row[2].split(","):
+                    umi, count = item.rsplit(":", 1)
+                    umis.append((umi, int(count)))
+            table[row[0]] = (int(row[1]), umis)
+    return table
+
+
+def expand_sam(sam_lines, table, on_alignment=None):
+    """ Yield the SAM lines, with every alignment repeated once per original read.
+        `on_alignment(rest, reads)` is called for every collapsed alignment line,
+        with the line without its QNAME, and the number of original reads.
+    """
+    for line in sam_lines:
+        if line.startswith("@"):
+            yield line
+            continue
+        qname, rest = line.split("\t", 1)
+        reads, umis = table[qname]
+        if on_alignment is not None:
+            on_alignment(rest, reads)
+        k = 0
+        if umis:
+            for umi, count in umis:
+                for _ in xrange(count):
+                    yield "%s.%d:UMI:%s:\t%s" % (qname, k, umi, rest)
+                    k += 1
+        else:
+            for _ in xrange(reads):
+                yield "%s.%d\t%s" % (qname, k, rest)
+                k += 1
+
+
+def main(input_files, output_dir, use_quality="false", procs=1):
+    """ Collapse every input FASTQ file into output_dir """
+    use_quality = str(use_quality).lower() in ["true", "yes", "1"]
+    jobs = [(fastq_file, output_dir, use_quality) for fastq_file in input_files]
+    pool = Pool(int(procs))
+    try:
+        results = pool.map(collapse_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    reads = sum(r[0] for r in results)
+    distinct = sum(r[1] for r in results)
+    logger.info("collapsed %d reads into %d distinct sequences", reads, distinct)
@@ -0,0 +1,199 @@
+#!/usr/bin/python2
+""" Write and load the count matrix in several formats.
+
+The matrix has a row per feature and a column per sample. htseq_count_umified
+adds summary rows (no_feature, ambiguous, ...) after the features.
+
+  - tsv     : the text matrix htseq_wrapper has always written, with the summary rows.
+  - mtx     : Matrix Market (coordinate) of the nonzero counts, in <name>.mtx, with
+              the feature and sample names in <name>.features.txt and
+              <name>.samples.txt, and the summary rows in <name>.summary.tsv.
+  - npz     : a compressed numpy archive, <name>.npz, of the matrix in CSC form
+              (data, indices, indptr, shape), the names and the summary rows.
+  - columns : a directory, <name>.columns, of the names, and of the dense matrix
+              and the summary rows as .npy files, in column order, so
+              `load_matrix` memory maps them.
+
+<name> is the count file name without its extension. Single-cell plates give
+mostly zeros, so the sparse formats are much smaller than the text one.
+
+`load_matrix` returns a CountMatrix, without parsing text for the binary
+formats. Its counts are a numpy array (tsv, columns) or a scipy.sparse CSC
+matrix (mtx, npz). scipy is only needed to load the sparse formats.
+"""
+
+from __future__ import print_function, division
+
+import os
+import csv
+import json
+from collections import namedtuple
+
+import numpy
+
+from htseq_count_umified import SUMMARY_FEATURES, COLLAPSED_FEATURE
+
+FORMATS = ("tsv", "mtx", "npz", "columns")
+SUMMARY_ROWS = set(SUMMARY_FEATURES + [COLLAPSED_FEATURE])
+EXTENSIONS = {"mtx": ".mtx", "npz": ".npz", "columns": ".columns"}
+
+CountMatrix = namedtuple("CountMatrix", ["counts", "features", "samples", "summary", "summary_rows"])
+
+
+def matrix_filename(filename, matrix_format):
+    """ The file (or directory) a matrix format is written to, for this count file name """
+    if matrix_format == "tsv":
+        return filename
+    return os.path.splitext(filename)[0] + EXTENSIONS[matrix_format]
+
+
+def feature_rows(rows):
+    """ The number of feature rows, before the summary rows """
+    n = len(rows)
+    while n > 0 and rows[n - 1] in SUMMARY_ROWS:
+        n -= 1
+    return n
+
+
+def write_names(names, filename):
+    with open(filename, "w") as fh:
+        for name in names:
+            fh.write(name + "\n")
+
+
+def read_names(filename):
+    with open(filename) as fh:
+        return [line.rstrip("\n") for line in fh]
+
+
+def write_tsv(rows, columns, samples, filename):
+    matrix_header = ["#Sample:"] + samples
+    with open(filename, "w") as fh:
+        matwriter = csv.writer(fh, delimiter='\t')
+        matwriter.writerow(matrix_header)
+        for row, counts in zip(rows, columns):
+            matwriter.writerow([row] + counts.tolist())
+
+
+def sparse_columns(columns):
+    """ The (data, indices, indptr) of the CSC form of a dense matrix, a column at a time """
+    data = []
+    indices = []
+    indptr = [0]
+    for n in xrange(columns.shape[1]):
+        column = numpy.asarray(columns[:, n])
+        nonzero = numpy.flatnonzero(column)
+        data.append(column[nonzero])
+        indices.append(nonzero)
+        indptr.append(indptr[-1] + len(nonzero))
+    return (numpy.concatenate(data) if data else numpy.zeros(0, dtype=numpy.int64),
+            numpy.concatenate(indices) if indices else numpy.zeros(0, dtype=numpy.int64),
+            numpy.array(indptr, dtype=numpy.int64))
+
+
+def write_mtx(features, counts, samples, summary_rows, summary, filename):
+    data, indices, indptr = sparse_columns(counts)
+    stem = os.path.splitext(filename)[0]
+    with open(filename, "w") as fh:
+        fh.write("%%MatrixMarket matrix coordinate integer general\n")
+        fh.write("%d %d %d\n" % (len(features), len(samples), len(data)))
+        for n in xrange(len(samples)):
+            for i in xrange(indptr[n], indptr[n + 1]):
+                # 1-based row, column
+                fh.write("%d %d %d\n" % (indices[i] + 1, n + 1, data[i]))
+    write_names(features, stem + ".features.txt")
+    write_names(samples, stem + ".samples.txt")
+    write_tsv(summary_rows, summary, samples, stem + ".summary.tsv")
+
+
+def write_npz(features, counts, samples, summary_rows, summary, filename):
+    data, indices, indptr = sparse_columns(counts)
+    numpy.savez_compressed(filename, data=data, indices=indices, indptr=indptr,
+                           shape=numpy.array([len(features), len(samples)]),
+                           features=numpy.array(features), samples=numpy.array(samples),
+                           summary=numpy.asarray(summary), summary_rows=numpy.array(summary_rows))
+
+
+def write_column_dir(features, counts, samples, summary_rows, summary, dirname):
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    numpy.save(os.path.join(dirname, "counts.npy"), numpy.asfortranarray(counts))
+    numpy.save(os.path.join(dirname, "summary.npy"), numpy.asfortranarray(summary))
+    with open(os.path.join(dirname, "names.json"), "w") as fh:
+        json.dump({"features": features, "samples": samples, "summary_rows": summary_rows}, fh)
+
+
+def write_matrix(rows, columns, samples, filename, matrix_format="tsv"):
+    """ Write a rows x samples integer array (e.g. a numpy memmap) in a matrix
+        format. filename is the name of the tsv count file, see matrix_filename.
+        Returns the name of the written file.
+    """
+    assert (matrix_format in FORMATS), "Unknown matrix format %s" % matrix_format
+    filename = matrix_filename(filename, matrix_format)
+    if matrix_format == "tsv":
+        write_tsv(rows, columns, samples, filename)
+        return filename
+    n = feature_rows(rows)
+    args = (list(rows[:n]), columns[:n], list(samples), list(rows[n:]), columns[n:], filename)
+    if matrix_format == "mtx":
+        write_mtx(*args)
+    elif matrix_format == "npz":
+        write_npz(*args)
+    else:
+        write_column_dir(*args)
+    return filename
+
+
+def load_tsv(filename):
+    with open(filename, "rb") as fh:
+        reader = csv.reader(fh, delimiter='\t')
+        samples = next(reader)[1:]
+        rows = []
+        values = []
+        for row in reader:
+            rows.append(row[0])
+            values.append([int(value) for value in row[1:]])
+    matrix = numpy.array(values, dtype=numpy.int64).reshape(len(rows), len(samples))
+    n = feature_rows(rows)
+    return CountMatrix(matrix[:n], rows[:n], samples, matrix[n:], rows[n:])
+
+
+def load_mtx(filename):
+    import scipy.io
+    stem = os.path.splitext(filename)[0]
+    summary = load_tsv(stem + ".summary.tsv")
+    return CountMatrix(scipy.io.mmread(filename).tocsc(), read_names(stem + ".features.txt"),
+                       read_names(stem + ".samples.txt"), summary.summary, summary.summary_rows)
+
+
+def load_npz(filename):
+    import scipy.sparse
+    with numpy.load(filename) as npz:
+        counts = scipy.sparse.csc_matrix((npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"]))
+        return CountMatrix(counts, npz["features"].tolist(), npz["samples"].tolist(),
+                           npz["summary"], npz["summary_rows"].tolist())
+
+
+def load_column_dir(dirname, mmap_mode="r"):
+    with open(os.path.join(dirname, "names.json")) as fh:
+        names = json.load(fh)
+    # json gives unicode strings
+    names = dict((key, [str(name) for name in value]) for key, value in names.iteritems())
+    return CountMatrix(numpy.load(os.path.join(dirname, "counts.npy"), mmap_mode=mmap_mode),
+                       names["features"], names["samples"],
+                       numpy.load(os.path.join(dirname, "summary.npy"), mmap_mode=mmap_mode),
+                       names["summary_rows"])
+
+
+def load_matrix(filename):
+    """ Load a count matrix written in any format. Returns a CountMatrix:
+        the features x samples counts, the feature and sample names, and the
+        summary rows x samples counts with their names.
+    """
+    if os.path.isdir(filename):
+        return load_column_dir(filename)
+    if filename.endswith(".mtx"):
+        return load_mtx(filename)
+    if filename.endswith(".npz"):
+        return load_npz(filename)
+    return load_tsv(filename)
@@ -0,0 +1,106 @@
+#!/usr/bin/python2
+""" Per-sample count results, kept between runs of htseq_wrapper.
+
+The counts of every sample are saved as an integer array (a column of the
+matrix) named by a hash of the contents of its SAM/BAM file and of the
+counting parameters: the feature index (which is named by the GFF file), the
+strandedness (yes, no or reverse), the feature type, the id attribute, the
+overlap mode, the minimal quality and the UMI options. When a new plate is
+added, only the new or changed samples are counted, and the matrix is put
+together from the saved columns of the others.
+
+Hashing a large SAM file takes a while, so the hashes are kept too, in
+HASH_FILE, with the size and modification time of the file they were made
+from. A file with the same size and time is not hashed again.
+"""
+
+from __future__ import print_function, division
+
+import os
+import json
+import hashlib
+import tempfile
+from logging import getLogger
+
+import numpy
+
+logger = getLogger('pijp.count_store')
+
+# change this when the saved counts change
+STORE_VERSION = "2"
+HASH_FILE = "file_hashes.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(filename):
+    """ The sha1 of the contents of a file """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as fh:
+        for data in iter(lambda: fh.read(HASH_BLOCK_SIZE), ""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def params_key(index_dir, args):
+    """ The hash of the parameters that change the counts, for htseq_wrapper arguments """
+    key = hashlib.sha1()
+    # the index is named by the GFF file, but only by whether the counting is stranded
+    key.update("\t".join([STORE_VERSION, os.path.basename(os.path.normpath(index_dir)), args.stranded,
+                          args.featuretype, args.idattr, args.mode, str(args.minaqual), str(args.umis),
+                          args.umi_collapse if args.umis else "none"]))
+    return key.hexdigest()
+
+
+def file_stat(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+
+class CountStore(object):
+    """ The saved counts in store_dir, and the hashes of the counted files """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.hash_file = os.path.join(store_dir, HASH_FILE)
+        # absolute file name -> [size, mtime, sha1]
+        self.hashes = dict()
+        if os.path.exists(self.hash_file):
+            with open(self.hash_file) as fh:
+                self.hashes = json.load(fh)
+
+    def known_hash(self, filename):
+        """ The saved hash of a file, or None if it changed since (or was never hashed) """
+        entry = self.hashes.get(os.path.abspath(filename))
+        if entry is None or entry[:2] != file_stat(filename):
+            return None
+        return str(entry[2])
+
+    def set_hash(self, filename, digest):
+        self.hashes[os.path.abspath(filename)] = file_stat(filename) + [digest]
+
+    def save(self):
+        """ Save the hashes """
+        fd, tmp_file = tempfile.mkstemp(dir=self.store_dir)
+        with os.fdopen(fd, "w") as fh:
+            json.dump(self.hashes, fh)
+        os.rename(tmp_file, self.hash_file)
+
+    def counts_file(self, digest, params):
+        return os.path.join(self.store_dir, "%s.%s.npy" % (digest, params))
+
+    def load(self, digest, params):
+        """ The saved counts of a file hash and parameters, or None """
+        counts_file = self.counts_file(digest, params)
+        if not os.path.exists(counts_file):
+            return None
+        return numpy.load(counts_file)
+
+    def store(self, digest, params, counts):
+        """ Save the counts of a file hash and parameters """
+        fd, tmp_file = tempfile.mkstemp(dir=self.store_dir, suffix=".npy")
+        with os.fdopen(fd, "wb") as fh:
+            numpy.save(fh, numpy.asarray(counts, dtype=numpy.int64))
+        # written aside, so a half written file is never loaded
+        os.rename(tmp_file, self.counts_file(digest, params))
@@ -0,0 +1,209 @@
+#!/usr/bin/python2
+""" Executors run the units of work of a segment (e.g. the alignment or the
+counting of one sample), either locally or on the nodes of a cluster.
+
+  - LocalExecutor : a pool of worker processes on this machine.
+  - BatchExecutor : one job array of a batch scheduler for all the units. The
+                    function and the argument of every unit are pickled into a
+                    directory on a shared filesystem, every array task runs one
+                    unit (`executors.py run`), and writes its result next to it.
+                    The submit command waits for the whole array.
+
+The schedulers of BatchExecutor are in SCHEDULERS: "slurm", "sge", and "fake",
+which runs the array tasks as local processes (`executors.py fake`), for
+testing the batch path without a cluster.
+
+pijpleiding makes the executor of the [executor] section of the config file
+(`from_config`), and passes it to the segments that take an `executor`
+argument. The functions must be module level, so they can be pickled.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import pipes
+import shutil
+import pickle
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+from logging import getLogger
+from multiprocessing import Pool
+
+logger = getLogger('pijp.executors')
+
+EXECUTORS_SCRIPT = os.path.abspath(__file__).replace(".pyc", ".py")
+# submit command template, array task index variable, index of the first task
+SCHEDULERS = {
+    "slurm": ("sbatch --wait --array=0-{last} --cpus-per-task={threads} --job-name={name} "
+              "--output={job_dir}/%a.log {options} {script}", "SLURM_ARRAY_TASK_ID", 0),
+    "sge": ("qsub -sync y -t 1-{count} -pe {parallel_env} {threads} -N {name} -o {job_dir} -j y "
+            "{options} {script}", "SGE_TASK_ID", 1),
+    "fake": ("{python} {executors} fake {count} {script}", "FAKE_ARRAY_TASK_ID", 0),
+}
+# the tasks run in the directory of the submit, so relative paths mean the same
+JOB_SCRIPT = """#!/bin/sh
+cd {cwd} || exit 1
+exec {python} {executors} run {job_dir} ${index_var} {first}
+"""
+
+
+def call(func_arg):
+    """ Run a unit. Returns (error, result) """
+    func, arg = func_arg
+    try:
+        return None, func(arg)
+    except Exception:
+        return traceback.format_exc(), None
+
+
+def check(name, (error, result)):
+    if error is not None:
+        raise RuntimeError("unit %s failed:\n%s" % (name, error))
+    return result
+
+
+class LocalExecutor(object):
+    """ Runs the units on `procs` processes (default: the number of cores) """
+
+    def __init__(self, procs=0):
+        self.procs = int(procs or 0) or multiprocessing.cpu_count()
+
+    def imap_unordered(self, func, args, threads=1):
+        """ Yield the results of func(arg) for every arg, as they finish. A unit
+            that uses `threads` threads takes as many of the processes.
+        """
+        args = list(args)
+        if not args:
+            return
+        pool = Pool(max(1, min(self.procs // threads, len(args))))
+        try:
+            for out in pool.imap_unordered(call, [(func, arg) for arg in args]):
+                yield check(func.__name__, out)
+        finally:
+            pool.close()
+            pool.join()
+
+    def map(self, func, args, threads=1):
+        """ The results of func(arg) for every arg, in order """
+        args = list(args)
+        results = dict(self.imap_unordered(numbered, [(n, func, arg) for n, arg in enumerate(args)], threads))
+        return [results[n] for n in range(len(args))]
+
+
+def numbered((n, func, arg)):
+    return n, func(arg)
+
+
+class BatchExecutor(object):
+    """ Runs the units as one job array of a batch scheduler. work_dir must be
+        on a filesystem that the nodes share. `options` are added to the submit
+        command (e.g. a queue or a memory limit). `parallel_env` is the SGE
+        parallel environment that the threads of a unit are asked for in.
+    """
+
+    def __init__(self, work_dir, scheduler="slurm", options="", name="pijp", parallel_env="smp"):
+        assert (scheduler in SCHEDULERS), "Unknown scheduler %s" % scheduler
+        self.work_dir = os.path.abspath(work_dir)
+        self.scheduler = scheduler
+        self.options = options
+        self.name = name
+        self.parallel_env = parallel_env
+
+    def map(self, func, args, threads=1):
+        """ The results of func(arg) for every arg, in order """
+        args = list(args)
+        if not args:
+            return []
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+        job_dir = tempfile.mkdtemp(dir=self.work_dir, prefix=self.name + ".")
+        for n, arg in enumerate(args):
+            with open(unit_file(job_dir, n), "wb") as fh:
+                pickle.dump((func, arg), fh, pickle.HIGHEST_PROTOCOL)
+        template, index_var, first = SCHEDULERS[self.scheduler]
+        script = os.path.join(job_dir, "job.sh")
+        with open(script, "w") as fh:
+            fh.write(JOB_SCRIPT.format(python=sys.executable, executors=EXECUTORS_SCRIPT, job_dir=job_dir,
+                                       index_var=index_var, first=first, cwd=pipes.quote(os.getcwd())))
+        os.chmod(script, 0755)
+        cmd = template.format(python=sys.executable, executors=EXECUTORS_SCRIPT, script=script,
+                              count=len(args), last=len(args) - 1, threads=threads, name=self.name,
+                              job_dir=job_dir, options=self.options, parallel_env=self.parallel_env)
+        logger.info("submitting %d units : %s", len(args), cmd)
+        returncode = subprocess.call(cmd, shell=True)
+        results = []
+        for n in range(len(args)):
+            if not os.path.exists(result_file(job_dir, n)):
+                raise RuntimeError("unit %d of %s did not finish (submit returned %d), see %s" %
+                                   (n, job_dir, returncode, job_dir))
+            with open(result_file(job_dir, n), "rb") as fh:
+                results.append(check(n, pickle.load(fh)))
+        shutil.rmtree(job_dir)
+        return results
+
+    def imap_unordered(self, func, args, threads=1):
+        """ The results, once the whole array is done """
+        return iter(self.map(func, args, threads))
+
+
+def unit_file(job_dir, n):
+    return os.path.join(job_dir, "unit%d.pkl" % n)
+
+
+def result_file(job_dir, n):
+    return os.path.join(job_dir, "result%d.pkl" % n)
+
+
+def run_unit(job_dir, n):
+    """ Array task: run unit n of job_dir, and save its (error, result) """
+    with open(unit_file(job_dir, n), "rb") as fh:
+        func_arg = pickle.load(fh)
+    out = call(func_arg)
+    # written aside, so a half written result is never read
+    fd, tmp_file = tempfile.mkstemp(dir=job_dir)
+    with os.fdopen(fd, "wb") as fh:
+        pickle.dump(out, fh, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, result_file(job_dir, n))
+
+
+def fake_array(count, script, procs=0):
+    """ Run the array tasks of a job script as local processes, as a scheduler would """
+    procs = int(procs or 0) or multiprocessing.cpu_count()
+    running = []
+    failed = 0
+    for n in range(count):
+        env = dict(os.environ)
+        env[SCHEDULERS["fake"][1]] = str(n)
+        running.append(subprocess.Popen([script], env=env))
+        if len(running) >= procs:
+            failed += running.pop(0).wait() != 0
+    for pro in running:
+        failed += pro.wait() != 0
+    return failed
+
+
+def from_config(parameters):
+    """ The executor of the [executor] section of the config file: backend (local,
+        or a scheduler of SCHEDULERS), and work_dir, options and parallel_env (for
+        sge, default smp) for a scheduler.
+        None for local, as each segment runs its units on its own processes
+        (bowtie_wrapper with its core scheduler, htseq_wrapper with a LocalExecutor).
+    """
+    parameters = dict(parameters)
+    backend = parameters.get("backend", "local")
+    if backend == "local":
+        return None
+    return BatchExecutor(parameters["work_dir"], backend, parameters.get("options", ""),
+                         parallel_env=parameters.get("parallel_env") or "smp")
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "run":
+        # run <job_dir> <array index> <index of the first task>
+        run_unit(sys.argv[2], int(sys.argv[3]) - int(sys.argv[4]))
+    elif sys.argv[1] == "fake":
+        # fake <count> <script>
+        sys.exit(1 if fake_array(int(sys.argv[2]), sys.argv[3]) else 0)
@@ -0,0 +1,203 @@
+#!/usr/bin/python2
+""" A single container file for the reads of many samples.
+
+With hundreds or thousands of samples, bc_demultiplex would keep one open file
+per sample. Instead, it can write all of them into one append-only container.
+The reads of each sample are buffered, and every full buffer is appended to
+the container as one block (compressed as a gzip member or BGZF blocks, if
+asked to). An index file (the container name + ".idx") lists the sample, offset
+and length of every block, in the order of writing.
+
+Usage, to stream one sample as FASTQ (e.g. into `bowtie2 -U -`):
+
+    fastq_container.py CONTAINER SAMPLE_NAME
+
+Without a sample name, the sample names are listed.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import csv
+import zlib
+import argparse
+from collections import deque, OrderedDict
+from logging import getLogger
+
+import fastq_output
+
+logger = getLogger('pijp.fastq_container')
+
+INDEX_SUFFIX = ".idx"
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class Container(object):
+    """ An append-only container, written through SampleWriter objects """
+
+    def __init__(self, filename, compression="none", level=6, pool=None, buffer_size=fastq_output.BUFFER_SIZE):
+        assert (compression in fastq_output.COMPRESSIONS), "Unknown compression %s" % compression
+        assert (compression == "none" or pool is not None), "Compression needs a thread pool"
+        self.filename = filename
+        self.compression = compression
+        self.level = level
+        self.pool = pool
+        self.buffer_size = buffer_size
+        self.fh = open(filename, "wb")
+        self.index = []
+        self.offset = 0
+        self._pending = deque()
+        self._writers = []
+
+    def writer(self, name):
+        """ A file-like writer for the sample `name` """
+        writer = SampleWriter(self, name)
+        self._writers.append(writer)
+        return writer
+
+    def append(self, name, data):
+        """ Append a block of records of one sample """
+        if self.compression == "none":
+            self._write_block(name, data)
+            return
+        compress = fastq_output.COMPRESSORS[self.compression]
+        self._pending.append((name, self.pool.apply_async(compress, (data, self.level))))
+        while self._pending and (self._pending[0][1].ready() or len(self._pending) > fastq_output.MAX_PENDING):
+            name, result = self._pending.popleft()
+            self._write_block(name, result.get())
+
+    def _write_block(self, name, data):
+        self.fh.write(data)
+        self.index.append((name, self.offset, len(data)))
+        self.offset += len(data)
+
+    def close(self):
+        if self.fh.closed:
+            return
+        for writer in self._writers:
+            writer.flush()
+        while self._pending:
+            name, result = self._pending.popleft()
+            self._write_block(name, result.get())
+        self.fh.close()
+        write_index(self.filename, self.compression, self.index)
+
+
+class SampleWriter(object):
+    """ Buffers the records of one sample, and appends full buffers to the container """
+
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.pool = container.pool
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.container.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffered:
+            self.container.append(self.name, "".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def write_index(filename, compression, index):
+    with open(filename + INDEX_SUFFIX, "w") as fh:
+        fh.write("#compression\t%s\n" % compression)
+        index_writer = csv.writer(fh, delimiter='\t')
+        index_writer.writerows(index)
+
+
+def read_index(filename):
+    """ Returns the compression, and the list of (name, offset, length) blocks """
+    index = []
+    with open(filename + INDEX_SUFFIX) as fh:
+        compression = fh.readline().rstrip("\n").split("\t")[1]
+        for name, offset, length in csv.reader(fh, delimiter='\t'):
+            index.append((name, int(offset), int(length)))
+    return compression, index
+
+
+def is_container(filename):
+    return os.path.exists(filename + INDEX_SUFFIX)
+
+
+def sample_names(filename):
+    """ The names of the samples in the container, in order of first block """
+    compression, index = read_index(filename)
+    return list(OrderedDict((name, True) for name, offset, length in index))
+
+
+def sample_sizes(filename):
+    """ The number of (stored) bytes of each sample in the container """
+    compression, index = read_index(filename)
+    sizes = dict()
+    for name, offset, length in index:
+        sizes[name] = sizes.get(name, 0) + length
+    return sizes
+
+
+def _decompress_members(data):
+    """ Decompress concatenated gzip members (and BGZF blocks) """
+    out = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return "".join(out)
+
+
+def stream_sample(filename, name, out_fh):
+    """ Write the reads of one sample, as FASTQ, to an open file """
+    compression, index = read_index(filename)
+    with open(filename, "rb") as fh:
+        for block_name, offset, length in index:
+            if block_name != name:
+                continue
+            fh.seek(offset)
+            if compression == "none":
+                while length > 0:
+                    data = fh.read(min(length, READ_BLOCK_SIZE))
+                    out_fh.write(data)
+                    length -= len(data)
+            else:
+                out_fh.write(_decompress_members(fh.read(length)))
+
+
+def merge_parts(filename, part_filenames):
+    """ Concatenate container parts (in the given order), and delete them """
+    index = []
+    offset = 0
+    compression = None
+    with open(filename, "wb") as out_fh:
+        for part_filename in part_filenames:
+            compression, part_index = read_index(part_filename)
+            for name, part_offset, length in part_index:
+                index.append((name, offset + part_offset, length))
+            with open(part_filename, "rb") as part_fh:
+                fastq_output.copy_part(part_fh, out_fh)
+            offset += os.path.getsize(part_filename)
+            os.remove(part_filename)
+            os.remove(part_filename + INDEX_SUFFIX)
+    write_index(filename, compression, index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= __doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('container', type=str)
+    parser.add_argument('sample', type=str, nargs='?')
+    args = parser.parse_args()
+    if args.sample is None:
+        for name in sample_names(args.container):
+            print(name)
+    else:
+        stream_sample(args.container, args.sample, sys.stdout)
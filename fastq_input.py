@@ -0,0 +1,382 @@
+#!/usr/bin/python2
+""" Reading parts of FASTQ files.
+
+Used by bc_demultiplex to split one large R1/R2 pair into synchronized chunks,
+so that the chunks can be demultiplexed in parallel.
+
+The index of a file holds the offset of every `stride`-th record. For
+uncompressed files these are plain byte offsets. For BGZF files (e.g. made with
+`bgzip`) these are virtual offsets, as in BAM files: the offset of the
+compressed block shifted 16 bits left, plus the offset inside the uncompressed
+block. Plain gzip files cannot be entered in the middle, so they are not split.
+
+Records are assumed to be 4 lines long, as HTSeq's FastqReader does.
+
+It also has the reading side of the "raw" demultiplexing engine, which works on
+batches of lines instead of HTSeq objects (see `record_batches`), and a
+read-ahead thread (`ReadAhead`) that decompresses and splits a file while the
+demultiplexing loop works on the previous batches.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import gzip
+import struct
+import zlib
+import time
+import threading
+import Queue
+from logging import getLogger
+
+logger = getLogger('pijp.fastq_input')
+
+BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_STRIDE = 65536
+# number of batches a read-ahead thread may be ahead of the reader
+READAHEAD_QUEUE_SIZE = 4
+
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+BGZF_HEADER = struct.Struct("<4BI2BH2B2H")  # up to and including BSIZE
+
+
+class FastqIndexError(Exception):
+    pass
+
+
+def fastq_base_name(fastq_file):
+    """ The file name without directory and extension. bowtie2 reads gzipped
+        files as they are, so "x.fastq.gz" is also "x".
+    """
+    base_name = os.path.basename(fastq_file)
+    if base_name.endswith(".gz"):
+        base_name = base_name[:-len(".gz")]
+    return os.path.splitext(base_name)[0]
+
+
+def is_bgzf(filename):
+    """ Check whether the file starts with a BGZF block header """
+    with open(filename, 'rb') as fh:
+        header = fh.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size or not header.startswith(BGZF_MAGIC):
+        return False
+    fields = BGZF_HEADER.unpack(header)
+    # the first (and only) extra subfield is "BC" with length 2
+    return (fields[8], fields[9], fields[10]) == (66, 67, 2)
+
+
+def bgzf_blocks(fh, coffset=0):
+    """ Yield (compressed offset, uncompressed data) for the BGZF blocks of an
+        open file, starting at block `coffset`.
+    """
+    fh.seek(coffset)
+    while True:
+        header = fh.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size or not header.startswith(BGZF_MAGIC):
+            raise FastqIndexError("Bad BGZF block at offset %d" % coffset)
+        bsize = BGZF_HEADER.unpack(header)[-1]
+        rest = fh.read(bsize + 1 - BGZF_HEADER.size)
+        # the compressed data is followed by the CRC32 and ISIZE fields.
+        data = zlib.decompress(rest[:-8], -15)
+        yield coffset, data
+        coffset += bsize + 1
+
+
+def _plain_blocks(fh, offset=0):
+    fh.seek(offset)
+    while True:
+        data = fh.read(BLOCK_SIZE)
+        if not data:
+            return
+        yield offset, data
+        offset += len(data)
+
+
+def build_index(filename, stride=DEFAULT_STRIDE):
+    """ Return (offsets, records) - the offsets of records 0, stride, 2*stride..
+        and the total number of records in the file.
+    """
+    bgzf = is_bgzf(filename)
+    lines_per_stride = 4 * stride
+    offsets = [0]
+    lines = 0
+    next_mark = lines_per_stride
+    # a BGZF mark at the very end of a block is moved to the start of the next one
+    pending = False
+    with open(filename, 'rb') as fh:
+        blocks = bgzf_blocks(fh) if bgzf else _plain_blocks(fh)
+        for block_offset, data in blocks:
+            if pending:
+                offsets.append(block_offset << 16)
+                pending = False
+            n = data.count("\n")
+            pos = -1
+            while lines + n >= next_mark:
+                # find the newline that ends the last line before the mark
+                for _ in xrange(next_mark - lines):
+                    pos = data.find("\n", pos + 1)
+                n -= next_mark - lines
+                lines = next_mark
+                next_mark += lines_per_stride
+                if not bgzf:
+                    offsets.append(block_offset + pos + 1)
+                elif pos + 1 == len(data):
+                    pending = True
+                else:
+                    offsets.append((block_offset << 16) | (pos + 1))
+            lines += n
+    if lines % 4 != 0:
+        raise FastqIndexError("%s has %d lines, which is not a multiple of 4" % (filename, lines))
+    records = lines // 4
+    if len(offsets) > 1 and (len(offsets) - 1) * stride == records:
+        # the last mark is the end of the file
+        offsets.pop()
+    return offsets, records
+
+
+class RangeReader(object):
+    """ A read-only file-like object for the records between two (virtual)
+        offsets of a FASTQ file. `end=None` reads to the end of the file.
+        Iterating it yields lines, so it can be given to HTSeq's FastqReader.
+    """
+
+    def __init__(self, filename, start=0, end=None):
+        self.fh = open(filename, 'rb')
+        if is_bgzf(filename):
+            self._blocks = self._bgzf_range(start, end)
+        else:
+            self._blocks = self._plain_range(start, end)
+        self._buffer = ""
+
+    def _plain_range(self, start, end):
+        for offset, data in _plain_blocks(self.fh, start):
+            if end is not None and offset + len(data) >= end:
+                yield data[:end - offset]
+                return
+            yield data
+
+    def _bgzf_range(self, start, end):
+        first = True
+        for coffset, data in bgzf_blocks(self.fh, start >> 16):
+            if end is not None and coffset == end >> 16:
+                data = data[:end & 0xffff]
+            if first:
+                data = data[start & 0xffff:]
+                first = False
+            yield data
+            if end is not None and coffset >= end >> 16:
+                return
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            data = next(self._blocks, None)
+            if data is None:
+                break
+            chunks.append(data)
+            length += len(data)
+        data = "".join(chunks)
+        if size < 0:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        rest = self._buffer
+        self._buffer = ""
+        for data in self._blocks:
+            lines = (rest + data).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+
+    def readline(self):
+        # not used in the demultiplexing loop, so it need not be fast.
+        data = self._buffer
+        while "\n" not in data:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            data += block
+        pos = data.find("\n") + 1 or len(data)
+        self._buffer = data[pos:]
+        return data[:pos]
+
+    def close(self):
+        self.fh.close()
+
+
+def chunk_pair(r1_file, r2_file, chunks, stride=DEFAULT_STRIDE):
+    """ Split an R1/R2 pair into up to `chunks` synchronized chunks.
+        Returns a list of ((r1_start, r1_end), (r2_start, r2_end)).
+        Returns None if the files cannot be split (i.e. plain gzip files).
+    """
+    for filename in (r1_file, r2_file):
+        if filename.endswith("gz") and not is_bgzf(filename):
+            logger.info("%s is gzipped but not BGZF, so it is not split", filename)
+            return None
+    r1_offsets, r1_records = build_index(r1_file, stride)
+    r2_offsets, r2_records = build_index(r2_file, stride)
+    if r1_records != r2_records:
+        raise FastqIndexError("%s has %d records, but %s has %d" %
+                              (r1_file, r1_records, r2_file, r2_records))
+
+    # group the strides into chunks of about the same size
+    strides = len(r1_offsets)
+    chunks = max(1, min(chunks, strides))
+    marks = [strides * k // chunks for k in range(chunks)]
+    ranges = []
+    for start, end in zip(marks, marks[1:] + [None]):
+        r1_range = (r1_offsets[start], None if end is None else r1_offsets[end])
+        r2_range = (r2_offsets[start], None if end is None else r2_offsets[end])
+        check_boundary(r1_file, r2_file, r1_range[0], r2_range[0])
+        ranges.append((r1_range, r2_range))
+    logger.info("split %s (%d reads) into %d chunks", r1_file, r1_records, len(ranges))
+    return ranges
+
+
+def check_boundary(r1_file, r2_file, r1_offset, r2_offset):
+    """ Check that both chunks start at a record, and at the same read """
+    names = []
+    for filename, offset in ((r1_file, r1_offset), (r2_file, r2_offset)):
+        reader = RangeReader(filename, offset)
+        try:
+            line = reader.readline()
+        finally:
+            reader.close()
+        if line and not line.startswith("@"):
+            raise FastqIndexError("Offset %d of %s is not a record start" % (offset, filename))
+        names.append(line.split()[0] if line.strip() else "")
+    if names[0] != names[1]:
+        raise FastqIndexError("Chunks of %s and %s start at different reads (%s, %s)" %
+                              (r1_file, r2_file, names[0], names[1]))
+
+
+def open_fastq(filename, start=0, end=None):
+    """ Open a FASTQ file (or a range of it) for reading raw data.
+        Plain gzip files are read with the gzip module.
+    """
+    if filename.endswith("gz") and (start, end) == (0, None) and not is_bgzf(filename):
+        return gzip.open(filename, 'rb')
+    return RangeReader(filename, start, end)
+
+
+def record_batches(fh, block_size=BLOCK_SIZE):
+    """ Read an open FASTQ file in large blocks. Yield lists of lines (without
+        the newlines), each holding a whole number of 4-line records.
+    """
+    rest = ""
+    while True:
+        data = fh.read(block_size)
+        if not data:
+            break
+        lines = (rest + data).split("\n")
+        rest = lines.pop()
+        cut = len(lines) - len(lines) % 4
+        if cut != len(lines):
+            rest = "\n".join(lines[cut:] + [rest])
+            del lines[cut:]
+        if lines:
+            yield lines
+    if rest:
+        # the file does not end with a newline
+        lines = rest.split("\n")
+        if len(lines) % 4 != 0:
+            raise FastqIndexError("Truncated FASTQ record at the end of the file")
+        yield lines
+
+
+def paired_batches(batches1, batches2):
+    """ Yield (lines1, lines2) batches with the same number of records from two
+        record_batches() generators. Stops at the end of the shorter one, like izip.
+    """
+    batches1, batches2 = iter(batches1), iter(batches2)
+    lines1, lines2 = [], []
+    while True:
+        if not lines1:
+            lines1 = next(batches1, None)
+        if not lines2:
+            lines2 = next(batches2, None)
+        if lines1 is None or lines2 is None:
+            return
+        n = min(len(lines1), len(lines2))
+        yield lines1[:n], lines2[:n]
+        lines1, lines2 = lines1[n:], lines2[n:]
+
+
+class ReadAhead(object):
+    """ Reads the record batches of an open FASTQ file in a background thread,
+        and hands them over through a bounded queue. zlib releases the GIL, so
+        decompressing runs in parallel with the consumer.
+        `wait_time` is the time the consumer spent waiting for batches.
+    """
+
+    def __init__(self, fh, queue_size=READAHEAD_QUEUE_SIZE, block_size=BLOCK_SIZE):
+        self.fh = fh
+        self.wait_time = 0.0
+        self.queue = Queue.Queue(queue_size)
+        # set by close(), so the thread stops even if not all the batches were read
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read, args=(block_size,))
+        # a daemon, so an unfinished file (see paired_batches) does not block the exit.
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        """ Queue an item, unless the reader is closed first. Returns whether it was queued. """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _read(self, block_size):
+        try:
+            for lines in record_batches(self.fh, block_size):
+                if not self._put(lines):
+                    return
+        except Exception:
+            self._put(sys.exc_info())
+            return
+        self._put(None)
+
+    def __iter__(self):
+        while True:
+            start = time.time()
+            item = self.queue.get()
+            self.wait_time += time.time() - start
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                # an exception in the reading thread
+                raise item[0], item[1], item[2]
+            yield item
+
+    def lines(self):
+        """ Yield the lines, with newlines, e.g. for HTSeq's FastqReader """
+        for batch in self:
+            for line in batch:
+                yield line + "\n"
+
+    def close(self):
+        """ Stop the thread, drop the batches that were not read, and close the file """
+        self.stop.set()
+        while True:
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            if not self.thread.is_alive():
+                break
+            self.thread.join(0.1)
+        self.fh.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/python2
+""" Writing the demultiplexed FASTQ files.
+
+Every output file gets a large write buffer. When the buffer is full, its
+content is compressed (if asked to) by a pool of threads that is shared by all
+the output files, and written in order. zlib releases the GIL while it
+compresses, so the threads really run in parallel to the splitting.
+
+Compression is one of:
+  - none : plain FASTQ.
+  - gzip : every buffer is written as a separate gzip member. Concatenated
+           members are a valid gzip file (zcat, bowtie2 and HTSeq read them).
+  - bgzf : blocked gzip, as made by `bgzip`. These files can also be split by
+           fastq_input.py.
+"""
+
+from __future__ import print_function, division
+
+import os
+import struct
+import zlib
+from collections import deque
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+logger = getLogger('pijp.fastq_output')
+
+COMPRESSIONS = ("none", "gzip", "bgzf")
+EXTENSIONS = {"none": "", "gzip": ".gz", "bgzf": ".gz"}
+
+BUFFER_SIZE = 256 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+# at most this many buffers of each file wait for compression
+MAX_PENDING = 4
+
+GZIP_HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = struct.Struct("<4BI2BH2B2H")
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _trailer(data):
+    return struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def gzip_member(data, level):
+    """ Compress data to a single gzip member """
+    return GZIP_HEADER + _deflate(data, level) + _trailer(data)
+
+
+def bgzf_blocks(data, level):
+    """ Compress data to BGZF blocks """
+    blocks = []
+    for start in xrange(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[start:start + BGZF_BLOCK_SIZE]
+        deflated = _deflate(block, level)
+        # BSIZE is the total block size minus 1
+        header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                                  BGZF_HEADER.size + len(deflated) + 8 - 1)
+        blocks.append(header + deflated + _trailer(block))
+    return "".join(blocks)
+
+
+COMPRESSORS = {"gzip": gzip_member, "bgzf": bgzf_blocks}
+
+
+class OutputWriter(object):
+    """ A buffered, optionally compressed, output file. Only write() and close()
+        are supported.
+    """
+
+    def __init__(self, filename, compression="none", level=6, pool=None, buffer_size=BUFFER_SIZE):
+        assert (compression in COMPRESSIONS), "Unknown compression %s" % compression
+        assert (compression == "none" or pool is not None), "Compression needs a thread pool"
+        self.filename = filename
+        self.compression = compression
+        self.level = level
+        self.pool = pool
+        self.buffer_size = buffer_size
+        self.fh = open(filename, "wb")
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self._written = False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._written = True
+        if self.compression == "none":
+            self.fh.write(data)
+            return
+        self._pending.append(self.pool.apply_async(COMPRESSORS[self.compression], (data, self.level)))
+        # write whatever is ready, and wait if too much is waiting.
+        while self._pending and (self._pending[0].ready() or len(self._pending) > MAX_PENDING):
+            self.fh.write(self._pending.popleft().get())
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.flush()
+        while self._pending:
+            self.fh.write(self._pending.popleft().get())
+        if self.compression == "bgzf":
+            self.fh.write(BGZF_EOF)
+        elif self.compression == "gzip" and not self._written:
+            # an empty file is not valid gzip, an empty member is
+            self.fh.write(gzip_member("", self.level))
+        self.fh.close()
+
+
+def compression_pool(compression, threads):
+    """ The thread pool for compressing, or None without compression """
+    return ThreadPool(threads) if compression != "none" else None
+
+
+def open_output_files(filenames, compression="none", level=6, threads=1, buffer_size=BUFFER_SIZE):
+    """ Open an OutputWriter for each value of the `filenames` dict.
+        All the writers share one pool of `threads` compression threads.
+    """
+    pool = compression_pool(compression, threads)
+    files_dict = dict()
+    for key, filename in filenames.items():
+        files_dict[key] = OutputWriter(filename, compression, level, pool, buffer_size)
+    return files_dict
+
+
+def close_output_files(files_dict):
+    """ Close the writers, the containers they write to (see fastq_container.py)
+        and their compression pool.
+    """
+    pools = set(writer.pool for writer in files_dict.values())
+    containers = set(getattr(writer, "container", None) for writer in files_dict.values())
+    try:
+        for writer in files_dict.values():
+            writer.close()
+        for container in containers - set([None]):
+            container.close()
+    finally:
+        for pool in pools - set([None]):
+            pool.close()
+            pool.join()
+
+
+def copy_part(part_fh, out_fh, strip_bgzf_eof=False):
+    """ Append an open part file to the output file. With `strip_bgzf_eof`,
+        leave out the BGZF end-of-file marker of the part.
+    """
+    length = os.fstat(part_fh.fileno()).st_size
+    if strip_bgzf_eof and length >= len(BGZF_EOF):
+        part_fh.seek(length - len(BGZF_EOF))
+        if part_fh.read() == BGZF_EOF:
+            length -= len(BGZF_EOF)
+        part_fh.seek(0)
+    while length > 0:
+        data = part_fh.read(min(COPY_BLOCK_SIZE, length))
+        if not data:
+            break
+        out_fh.write(data)
+        length -= len(data)
@@ -0,0 +1,202 @@
+#!/usr/bin/python2
+""" A feature index that is built once, saved to disk, and shared by the counting processes.
+
+count_reads_in_features used to parse the whole GFF file and build an
+HTSeq.GenomicArrayOfSets for every SAM file. Instead, the wrappers build the
+index once (`cached_index`). It is saved as step arrays: for each chromosome
+and strand, the start of every step, and the number of its set of features.
+The counting processes load it with numpy memory mapping (`FeatureIndex.load`),
+so they all share the same pages.
+
+The index is saved in a directory named by a hash of the GFF file (its path
+and contents), the feature type, the id attribute and the strandedness, so a
+changed GFF file or different parameters get a new index.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+from logging import getLogger
+
+import numpy
+import HTSeq
+
+logger = getLogger('pijp.feature_index')
+
+# change this when the saved format changes
+INDEX_VERSION = "1"
+META_FILE = "index.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def index_key(gff_filename, feature_type, id_attribute, stranded):
+    """ The hash that names the index of a GFF file with these parameters """
+    key = hashlib.sha1()
+    key.update("\t".join([INDEX_VERSION, os.path.abspath(gff_filename), feature_type, id_attribute,
+                          str(stranded != "no")]))
+    with open(gff_filename, "rb") as fh:
+        for data in iter(lambda: fh.read(HASH_BLOCK_SIZE), ""):
+            key.update(data)
+    return key.hexdigest()
+
+
+def read_features(gff_filename, feature_type, id_attribute, stranded, quiet=True):
+    """ Parse the GFF file as htseq-count does. Returns (GenomicArrayOfSets, feature ids) """
+    gff = HTSeq.GFF_Reader( gff_filename )
+    features = HTSeq.GenomicArrayOfSets( "auto", stranded != "no" )
+    feature_ids = set()
+    i = 0
+    try:
+        for f in gff:
+            if f.type == feature_type:
+                try:
+                    # added strip to avoid key error
+                    feature_id = f.attr[ id_attribute ].strip()
+                except KeyError:
+                    sys.exit( "Feature %s does not contain a '%s' attribute" %
+                        ( f.name, id_attribute ) )
+                if stranded != "no" and f.iv.strand == ".":
+                    sys.exit( "Feature %s at %s does not have strand information but you are "
+                        "running htseq-count in stranded mode. Use '--stranded=no'." %
+                        ( f.name, f.iv ) )
+                features[ f.iv ] += feature_id
+                feature_ids.add( feature_id )
+            i += 1
+            if i % 100000 == 0 and not quiet:
+                sys.stderr.write( "%d GFF lines processed.\n" % i )
+    except:
+        sys.stderr.write( "Error occured when processing GFF file (%s):\n" % gff.get_line_number_string() )
+        raise
+    if not quiet:
+        sys.stderr.write( "%d GFF lines processed.\n" % i )
+    return features, sorted(feature_ids)
+
+
+def step_arrays(features, feature_ids):
+    """ The step arrays of a GenomicArrayOfSets. Returns the list of
+        (chrom, strand, starts, set numbers) vectors, and the list of sets (as
+        lists of feature numbers).
+    """
+    id_numbers = dict((feature_id, n) for n, feature_id in enumerate(feature_ids))
+    # set number 0 is the empty set
+    set_numbers = {frozenset(): 0}
+    vectors = []
+    for chrom, strands in sorted(features.chrom_vectors.items()):
+        for strand, chrom_vector in sorted(strands.items()):
+            starts = []
+            values = []
+            for iv, fs in chrom_vector.steps():
+                key = frozenset(id_numbers[feature_id] for feature_id in fs)
+                starts.append(iv.start)
+                values.append(set_numbers.setdefault(key, len(set_numbers)))
+            vectors.append((chrom, strand, numpy.array(starts, dtype=numpy.int64),
+                            numpy.array(values, dtype=numpy.int32)))
+    sets = [None] * len(set_numbers)
+    for key, n in set_numbers.items():
+        sets[n] = sorted(key)
+    return vectors, sets
+
+
+def save_index(features, feature_ids, index_dir):
+    """ Save a GenomicArrayOfSets as step arrays in index_dir """
+    vectors, sets = step_arrays(features, feature_ids)
+    for n, (chrom, strand, starts, values) in enumerate(vectors):
+        numpy.save(os.path.join(index_dir, "starts%d.npy" % n), starts)
+        numpy.save(os.path.join(index_dir, "sets%d.npy" % n), values)
+    with open(os.path.join(index_dir, META_FILE), "w") as fh:
+        json.dump({"feature_ids": feature_ids, "sets": sets,
+                   "vectors": [(chrom, strand) for (chrom, strand, starts, values) in vectors],
+                   "stranded": features.stranded}, fh)
+
+
+def cached_index(gff_filename, feature_type, id_attribute, stranded, cache_dir):
+    """ Build the index of the GFF file in cache_dir, unless it is there already.
+        Returns the index directory.
+    """
+    index_dir = os.path.join(cache_dir, index_key(gff_filename, feature_type, id_attribute, stranded))
+    if os.path.exists(os.path.join(index_dir, META_FILE)):
+        logger.info("using the feature index %s", index_dir)
+        return index_dir
+    logger.info("building the feature index of %s in %s", gff_filename, index_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    features, feature_ids = read_features(gff_filename, feature_type, id_attribute, stranded)
+    # build it aside, so a half written index is never used
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        save_index(features, feature_ids, tmp_dir)
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        if not os.path.exists(os.path.join(index_dir, META_FILE)):
+            raise
+        # another process built it at the same time
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return index_dir
+
+
+class FeatureIndex(object):
+    """ A read-only feature index. It has the parts of GenomicArrayOfSets that
+        count_reads_in_features uses: `chrom_vectors` and `features[iv].steps()`.
+        `load` memory maps a saved index.
+    """
+
+    def __init__(self, feature_ids, sets, vectors, stranded):
+        self.feature_ids = feature_ids
+        self.sets = [set(feature_ids[n] for n in numbers) for numbers in sets]
+        self.stranded = stranded
+        # (chrom, strand) -> (starts, set numbers)
+        self.vectors = dict()
+        self.chrom_vectors = dict()
+        for chrom, strand, starts, values in vectors:
+            self.vectors[(chrom, strand)] = (starts, values)
+            self.chrom_vectors.setdefault(chrom, dict())[strand] = (starts, values)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, META_FILE)) as fh:
+            meta = json.load(fh)
+        vectors = []
+        for n, (chrom, strand) in enumerate(meta["vectors"]):
+            starts = numpy.load(os.path.join(index_dir, "starts%d.npy" % n), mmap_mode="r")
+            values = numpy.load(os.path.join(index_dir, "sets%d.npy" % n), mmap_mode="r")
+            # json gives unicode strings, HTSeq gives str
+            vectors.append((str(chrom), str(strand), starts, values))
+        feature_ids = [str(feature_id) for feature_id in meta["feature_ids"]]
+        return cls(feature_ids, meta["sets"], vectors, meta["stranded"])
+
+    @classmethod
+    def from_features(cls, features, feature_ids):
+        """ An index in memory, of a GenomicArrayOfSets """
+        vectors, sets = step_arrays(features, feature_ids)
+        return cls(feature_ids, sets, vectors, features.stranded)
+
+    def __getitem__(self, iv):
+        strand = iv.strand if self.stranded else "."
+        return _Steps(self.vectors[(iv.chrom, strand)], self.sets, iv.start, iv.end)
+
+
+class _Steps(object):
+
+    def __init__(self, vector, sets, start, end):
+        self.vector = vector
+        self.sets = sets
+        self.start = start
+        self.end = end
+
+    def steps(self):
+        """ Yield (None, feature set) for the steps that overlap the interval """
+        starts, values = self.vector
+        # the first step starts at 0, so there is always one that holds self.start
+        i = int(numpy.searchsorted(starts, self.start, "right")) - 1
+        yield None, self.sets[values[i]]
+        i += 1
+        while i < len(starts) and starts[i] < self.end:
+            yield None, self.sets[values[i]]
+            i += 1
@@ -2,13 +2,58 @@
 """ HTSeq-count adapted by Jaron et al
 """
 import sys, optparse, itertools, warnings, traceback, os.path, re
-from collections import Counter
+from collections import OrderedDict
 
 import HTSeq
 
+import feature_index as feature_index_module
+import batch_count
+import umi_sets
+
 class UnknownChrom( Exception ):
    pass
 
+# the default number of assignments that AssignmentCache keeps
+CACHE_SIZE = 100000
+# the rows that count_table adds after the features
+SUMMARY_FEATURES = [ 'no_feature', 'ambiguous', 'too_low_aQual', 'not_aligned', 'alignment_not_unique' ]
+COLLAPSED_FEATURE = 'umis_before_collapsing'
+
+class AssignmentCache( object ):
+   """ An LRU cache of the feature set assigned to the (chrom, strand, start, end)
+       intervals of a read. CEL-Seq reads pile up at the 3' ends, so many reads
+       have the same intervals.
+   """
+   def __init__( self, size=CACHE_SIZE ):
+      self.size = size
+      self.entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   def assign( self, iv_seq, assign ):
+      """ The cached assign( iv_seq ), which may raise UnknownChrom """
+      iv_seq = tuple( iv_seq )
+      key = tuple( ( iv.chrom, iv.strand, iv.start, iv.end ) for iv in iv_seq )
+      try:
+         fs = self.entries.pop( key )
+         self.hits += 1
+      except KeyError:
+         self.misses += 1
+         try:
+            fs = assign( iv_seq )
+         except UnknownChrom:
+            fs = UnknownChrom
+         if len( self.entries ) >= self.size:
+            self.entries.popitem( last=False )
+      # the most recently used entries are last
+      self.entries[ key ] = fs
+      if fs is UnknownChrom:
+         raise UnknownChrom
+      return fs
+
+   def __str__( self ):
+      return "assignment cache: %d hits, %d misses" % ( self.hits, self.misses )
+
 class EmptySamError(Exception):
    def __init__(self, sam_filename=''):
       self.sam_filename = sam_filename
@@ -26,7 +71,31 @@ def invert_strand( iv ):
    return iv2
 
 def count_reads_in_features( sam_filename, gff_filename, stranded, 
-      overlap_mode, feature_type, id_attribute, quiet, minaqual, samout, umis=False ):
+      overlap_mode, feature_type, id_attribute, quiet, minaqual, samout, umis=False, feature_index=None,
+      engine="htseq", cache_size=CACHE_SIZE, umi_collapse="none", procs=1, bam_threads=1 ):
+   """ feature_index is a directory made by feature_index.cached_index for this
+       GFF file and parameters. Without it, the GFF file is parsed here.
+       engine is "htseq", or "numpy" for the batch engine of batch_count.py.
+       cache_size is the size of the AssignmentCache of the htseq engine (0 for none).
+       umi_collapse is "none", "hamming" or "directional" (see umi_sets.py). When
+       UMIs are collapsed, a summary row has the number of UMIs before collapsing.
+       A coordinate sorted and indexed BAM file (*.bam) is counted by regions, in
+       `procs` processes, each decompressing with `bam_threads` threads (see
+       region_count.py).
+   """
+   args = ( gff_filename, stranded, overlap_mode, feature_type, id_attribute, quiet, minaqual,
+      samout, umis, feature_index, engine, cache_size, umi_collapse )
+   if isinstance( sam_filename, basestring ) and sam_filename.endswith( ".bam" ):
+      import region_count
+      return count_table( *region_count.count_bam( sam_filename, args, procs, bam_threads ) )
+   return count_table( *count_features( sam_filename, *args ) )
+
+def count_features( sam_filename, gff_filename, stranded, overlap_mode, feature_type, id_attribute,
+      quiet, minaqual, samout, umis, feature_index, engine, cache_size, umi_collapse ):
+   """ The counting of count_reads_in_features. Returns the counts dict, the
+       UmiCounter (or None without umis) and the summary counters, which can
+       be merged with those of other parts of the same sample.
+   """
       
    def write_to_samout( r, assignment ):
       if samoutfile is None:
@@ -48,60 +117,67 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
       samoutfile = None
       
    if umis :
-       umi_re = re.compile(":UMI:(\w+):")
-       umi_counts = {}
-       def count_umis(fs, read_name):
-           umi_seq = umi_re.search(read_name).group(1)
-           umi_counts[ fs ][umi_seq] +=1
+       # distinct UMIs of each feature, see umi_sets.py
+       umi_counts = umi_sets.UmiCounter( collapse=umi_collapse )
+       count_umis = umi_counts.add
    else:
        def count_umis(x,y): 
            return None
 
+   # sam_filename can also be an open file, or any iterable of SAM lines.
+   from_file = isinstance( sam_filename, basestring ) and sam_filename != "-"
+
    # Try to open samfile to fail early in case it is not there
-   if sam_filename != "-":
+   if from_file:
       open( sam_filename ).close()
       
-   #
-   gff = HTSeq.GFF_Reader( gff_filename )
-   features = HTSeq.GenomicArrayOfSets( "auto", stranded != "no" )     
-   i = 0
+   if feature_index is not None:
+      features = feature_index_module.FeatureIndex.load( feature_index )
+      feature_ids = features.feature_ids
+   else:
+      features, feature_ids = feature_index_module.read_features( gff_filename, feature_type,
+         id_attribute, stranded, quiet )
    counts = {}
-   try:
-      for f in gff:
-         if f.type == feature_type:
-            try:
-               # added strip to avoid key error
-               feature_id = f.attr[ id_attribute ].strip()
-            except KeyError:
-               sys.exit( "Feature %s does not contain a '%s' attribute" % 
-                  ( f.name, id_attribute ) )
-            if stranded != "no" and f.iv.strand == ".":
-               sys.exit( "Feature %s at %s does not have strand information but you are "
-                  "running htseq-count in stranded mode. Use '--stranded=no'." % 
-                  ( f.name, f.iv ) )
-            features[ f.iv ] += feature_id
-            counts[ feature_id ] = 0
-            if umis: umi_counts[ feature_id ] = Counter()
-         i += 1
-         if i % 100000 == 0 and not quiet:
-            sys.stderr.write( "%d GFF lines processed.\n" % i )
-   except:
-      sys.stderr.write( "Error occured when processing GFF file (%s):\n" % gff.get_line_number_string() )
-      raise
-      
-   if not quiet:
-      sys.stderr.write( "%d GFF lines processed.\n" % i )
+   for feature_id in feature_ids:
+      counts[ feature_id ] = 0
       
    if len( counts ) == 0 and not quiet:
       sys.stderr.write( "Warning: No features of type '%s' found.\n" % feature_type )
    
+   if engine == "numpy" and samout == "":
+      # look at the first alignment, as the batch engine counts single-end reads only
+      if from_file:
+         sam_lines = open( sam_filename )
+      else:
+         sam_lines = iter( sys.stdin if sam_filename == "-" else sam_filename )
+      head = []
+      for line in sam_lines:
+         head.append( line )
+         if not line.startswith( "@" ):
+            break
+      if len( head ) == 0 or head[-1].startswith( "@" ):
+         raise EmptySamError(sam_filename)
+      sam_lines = itertools.chain( head, sam_lines )
+      if int( head[-1].split( "\t", 2 )[1] ) & 1 == 0:
+         if not isinstance( features, feature_index_module.FeatureIndex ):
+            features = feature_index_module.FeatureIndex.from_features( features, feature_ids )
+         counter = batch_count.BatchCounter( features, stranded, overlap_mode, minaqual, counts,
+            count_umis if umis else None )
+         summary = counter.count( sam_lines )
+         if not quiet:
+            sys.stderr.write( "%d sam lines processed.\n" % counter.reads )
+         return counts, ( umi_counts if umis else None ), summary
+      # paired ends are counted by the HTSeq loop below
+      sam_filename = sam_lines
+      from_file = False
+
    try:
-      if sam_filename != "-":
+      if from_file:
          read_seq_file = HTSeq.SAM_Reader( sam_filename )
          read_seq = read_seq_file
          first_read = iter(read_seq).next()
       else:
-         read_seq_file = HTSeq.SAM_Reader( sys.stdin )
+         read_seq_file = HTSeq.SAM_Reader( sys.stdin if sam_filename == "-" else sam_filename )
          read_seq_iter = iter( read_seq_file )
          first_read = read_seq_iter.next()
          read_seq = itertools.chain( [ first_read ], read_seq_iter )
@@ -109,6 +185,31 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
    except StopIteration:
       raise EmptySamError(sam_filename)
 
+   def assign( iv_seq ):
+      if overlap_mode == "union":
+         fs = set()
+         for iv in iv_seq:
+            if iv.chrom not in features.chrom_vectors:
+               raise UnknownChrom
+            for iv2, fs2 in features[ iv ].steps():
+               fs = fs.union( fs2 )
+      elif overlap_mode == "intersection-strict" or overlap_mode == "intersection-nonempty":
+         fs = None
+         for iv in iv_seq:
+            if iv.chrom not in features.chrom_vectors:
+               raise UnknownChrom
+            for iv2, fs2 in features[ iv ].steps():
+               if len(fs2) > 0 or overlap_mode == "intersection-strict":
+                  if fs is None:
+                     fs = fs2.copy()
+                  else:
+                     fs = fs.intersection( fs2 )
+      else:
+         sys.exit( "Illegal overlap mode." )
+      return fs
+
+   cache = AssignmentCache( cache_size ) if cache_size > 0 else None
+
    try:
       if pe_mode:
          read_seq = HTSeq.pair_SAM_alignments( read_seq )
@@ -174,26 +275,10 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
                continue         
          
          try:
-            if overlap_mode == "union":
-               fs = set()
-               for iv in iv_seq:
-                  if iv.chrom not in features.chrom_vectors:
-                     raise UnknownChrom
-                  for iv2, fs2 in features[ iv ].steps():
-                     fs = fs.union( fs2 )
-            elif overlap_mode == "intersection-strict" or overlap_mode == "intersection-nonempty":
-               fs = None
-               for iv in iv_seq:
-                  if iv.chrom not in features.chrom_vectors:
-                     raise UnknownChrom
-                  for iv2, fs2 in features[ iv ].steps():
-                     if len(fs2) > 0 or overlap_mode == "intersection-strict":
-                        if fs is None:
-                           fs = fs2.copy()
-                        else:
-                           fs = fs.intersection( fs2 )
+            if cache is None:
+               fs = assign( iv_seq )
             else:
-               sys.exit( "Illegal overlap mode." )
+               fs = cache.assign( iv_seq, assign )
             if fs is None or len( fs ) == 0:
                write_to_samout( r, "no_feature" )
                empty += 1
@@ -216,34 +301,48 @@ def count_reads_in_features( sam_filename, gff_filename, stranded,
             #      ( rr.read.name, iv.chrom ) )
 
          if i % 100000 == 0 and not quiet:
-            sys.stderr.write( "%d sam %s processed.\n" % ( i, "lines " if not pe_mode else "line pairs" ) )
+            sys.stderr.write( "%d sam %s processed%s.\n" % ( i, "lines " if not pe_mode else "line pairs",
+               "" if cache is None else ", " + str( cache ) ) )
 
    except:
       sys.stderr.write( "Error occured when processing SAM input (%s):\n" % read_seq_file.get_line_number_string() )
       raise
 
    if not quiet:
-      sys.stderr.write( "%d sam %s processed.\n" % ( i, "lines " if not pe_mode else "line pairs" ) )
+      sys.stderr.write( "%d sam %s processed%s.\n" % ( i, "lines " if not pe_mode else "line pairs",
+         "" if cache is None else ", " + str( cache ) ) )
          
    if samoutfile is not None:
       samoutfile.close()
 
+   return counts, ( umi_counts if umis else None ), ( empty, ambiguous, lowqual, notaligned, nonunique )
+
+def count_table( counts, umi_counts, summary ):
+   """ The sorted features and their counts (the number of UMIs, with umi_counts),
+       followed by the summary counters.
+   """
    #sorted feature list. features+counts
    feats  = [ fn for fn in sorted(counts.keys()) ]
-   if umis:
-       counts = [ len(umi_counts[fn]) for fn in feats ]
+   collapsed = umi_counts is not None and umi_counts.collapse != "none"
+   if collapsed:
+       raw_umis = sum( umi_counts.raw_count(fn) for fn in feats )
+   if umi_counts is not None:
+       counts = [ umi_counts.count(fn) for fn in feats ]
    else:
        counts = [ counts[fn] for fn in feats ]
    #cat statistics summary to feature+count list
-   feats = feats + ['no_feature','ambiguous','too_low_aQual','not_aligned','alignment_not_unique']
-   counts = counts + [empty,ambiguous,lowqual,notaligned,nonunique]
+   feats = feats + SUMMARY_FEATURES
+   counts = counts + list(summary)
+   if collapsed:
+       feats = feats + [ COLLAPSED_FEATURE ]
+       counts = counts + [ raw_umis ]
    return (feats, counts)
 
 def main():
    
    optParser = optparse.OptionParser( 
       
-      usage = "%prog [options] sam_file gff_file",
+      usage = "%prog [options] sam_or_bam_file gff_file",
       
       description=
          "This script takes an alignment file in SAM format and a " +
@@ -292,6 +391,27 @@ def main():
    optParser.add_option( "-u", "--umis", action="store_true", dest="umis",
       help = "Count only unique UMIs - defined by read name with :UMI:TTTTT: " )
 
+   optParser.add_option( "-e", "--engine", type="choice", dest="engine",
+      choices = ( "htseq", "numpy" ), default = "htseq",
+      help = "'htseq' counts one alignment at a time, 'numpy' counts batches of " +
+         "single-end alignments with numpy (default: htseq)" )
+
+   optParser.add_option( "-c", "--cache-size", type="int", dest="cache_size",
+      default = CACHE_SIZE, help = "the number of read positions whose feature " +
+         "assignment is cached, 0 for no cache (default: %d)" % CACHE_SIZE )
+
+   optParser.add_option( "--umi-collapse", type="choice", dest="umi_collapse",
+      choices = umi_sets.COLLAPSE_MODES, default = "none",
+      help = "with -u, merge UMIs one mismatch apart: 'hamming' or 'directional' " +
+         "(default: none)" )
+
+   optParser.add_option( "-p", "--procs", type="int", dest="procs", default = 1,
+      help = "the number of processes that count the regions of a sorted, indexed " +
+         "BAM file (default: 1)" )
+
+   optParser.add_option( "--bam-threads", type="int", dest="bam_threads", default = 1,
+      help = "the number of BAM decompression threads of each process (default: 1)" )
+
    if len( sys.argv ) == 1:
       optParser.print_help()
       sys.exit(1)
@@ -307,7 +427,8 @@ def main():
    try:
       count_reads_in_features( args[0], args[1], opts.stranded, 
          opts.mode, opts.featuretype, opts.idattr, opts.quiet, opts.minaqual,
-         opts.samout, opts.umis)
+         opts.samout, opts.umis, engine=opts.engine, cache_size=opts.cache_size,
+         umi_collapse=opts.umi_collapse, procs=opts.procs, bam_threads=opts.bam_threads)
    except:
       sys.stderr.write( "  %s\n" % str( sys.exc_info()[1] ) )
       sys.stderr.write( "  [Exception type: %s, raised in %s:%d]\n" % 
@@ -3,6 +3,26 @@
     Should be used via pijpleiding.py
 
     Outputs one file, the expression matrix.
+
+    The workers send back each sample's counts as an integer array, in the
+    row order of the matrix (the features of the index, then the summary
+    rows). The columns are written to a memory mapped file as they come
+    in, so the parent does not keep all the samples in memory.
+
+    The counts of every sample are saved in `count_cache`, by the hash of its
+    SAM file and the counting parameters, so a rerun with new samples only
+    counts those. See count_store.py.
+
+    `matrix_format` is tsv (the default), or mtx, npz or columns for the
+    sparse and binary formats of count_matrix.py.
+
+    The feature index of the GFF file is built once, in `feature_cache`
+    (default: feature_index in the output dir), and shared by all the
+    counting processes. See feature_index.py.
+
+    Sorted and indexed BAM inputs (*.bam) are split into regions, which are
+    counted by the same processes as the other inputs, and then merged (see
+    region_count.py).
 """
 
 #import subprocess
@@ -11,10 +31,19 @@ import shlex
 import os.path
 import sys
 import csv
-from itertools import cycle
+import tempfile
 import argparse
+import multiprocessing
+
+import numpy
 
 import htseq_count_umified
+import count_matrix
+import count_store
+import executors
+import feature_index
+import region_count
+import umi_sets
 
 from multiprocessing import Pool
 
@@ -33,71 +62,196 @@ def build_argument_opts(cmd_line_params):
     parser.add_argument('-o','--samout',dest='samout',default='')
     parser.add_argument('-q','--quiet',dest='quiet',action="store_true",default=False)
     parser.add_argument('-u', '--umis', dest='umis',action="store_true",default=False)
+    parser.add_argument('-e', '--engine', dest='engine', choices=('htseq', 'numpy'), default='htseq')
+    parser.add_argument('-c', '--cache-size', type=int, dest='cache_size', default=htseq_count_umified.CACHE_SIZE)
+    parser.add_argument('--umi-collapse', dest='umi_collapse', choices=umi_sets.COLLAPSE_MODES, default='none')
     #parser.add_argument('-u', '--umis', dest='umis', action="store_true",default='False')
     
     arguments = parser.parse_args(shlex.split(cmd_line_params))
     return arguments
 
+def build_feature_index(extra_params, gff_file, cache_dir):
+    """ Build (or find) the feature index for these htseq-count arguments """
+    args = build_argument_opts(extra_params)
+    return feature_index.cached_index(gff_file, args.featuretype, args.idattr, args.stranded, cache_dir)
+
 def run_cmd(cmd):
-    """  Run the command, and return a feature/count list. 
-         If there was an error, return zeros. 
+    """  Run the command, and return the counts as an integer array, in the
+         rows of count_table. If there was an error, return None.
+         cmd is [extra_params, sam_file, gff_file, feature index dir or None]
+         or, for a region of a BAM file, [extra_params, bam_file, gff_file,
+         feature index dir, region, bam threads]. A region returns the
+         (counts, umi counter, summary) of region_count.count_region.
     """
     logger = getLogger("pijp.htseq")
     sam_file = cmd[1]
     gff_file = cmd[2]
+    index_dir = cmd[3] if len(cmd) > 3 else None
     args = build_argument_opts(cmd[0])
+    if len(cmd) > 4:
+         logger.info("counting region %s of %s", cmd[4], sam_file)
+         return region_count.count_region((sam_file, cmd[4], count_arguments(args, gff_file, index_dir), cmd[5]))
     logger.info("ran HTSeq-count: " + sam_file + ', '+ gff_file + ', ' + str(args))
     try:
          out = htseq_count_umified.count_reads_in_features( sam_file, gff_file, args.stranded,
                args.mode, args.featuretype, args.idattr, args.quiet, args.minaqual, 
-               args.samout, args.umis)
+               args.samout, args.umis, index_dir, args.engine, args.cache_size, args.umi_collapse)
     except htseq_count_umified.EmptySamError:
          logger.exception("HTSeq error with command : %s", cmd)
-         out = None
-    return out    
+         return None
+    return count_column(out)
+
+def run_job((n, cmd)):
+    """ run_cmd, with the number of the command, as results come in any order """
+    return n, run_cmd(cmd)
+
+def count_column(out):
+    """ The counts of a (feats, counts) table as an integer array """
+    return numpy.array(out[1], dtype=numpy.int64)
+
+def count_arguments(args, gff_file, index_dir):
+    """ The arguments of htseq_count_umified.count_features after the SAM file """
+    return (gff_file, args.stranded, args.mode, args.featuretype, args.idattr, args.quiet, args.minaqual,
+            args.samout, args.umis, index_dir, args.engine, args.cache_size, args.umi_collapse)
+
+def merge_regions(sam_file, results):
+    """ The count column of a BAM file from the results of its regions """
+    try:
+         return count_column(htseq_count_umified.count_table(*region_count.merge_results(results)))
+    except htseq_count_umified.EmptySamError:
+         getLogger("pijp.htseq").exception("HTSeq error with %s", sam_file)
+         return None
 
+def matrix_rows(index_dir, extra_params):
+    """ The row names of the matrix: the features of the index, then the summary rows """
+    args = build_argument_opts(extra_params)
+    rows = feature_index.FeatureIndex.load(index_dir).feature_ids + htseq_count_umified.SUMMARY_FEATURES
+    if args.umis and args.umi_collapse != "none":
+        rows = rows + [htseq_count_umified.COLLAPSED_FEATURE]
+    return rows
 
-def main(input_files, gff_file, output_dir, extra_params, count_filename, umi="false", procs=50):
+
+def hash_job(sam_file):
+    return sam_file, count_store.file_hash(sam_file)
+
+def input_hashes(store, input_files, procs):
+    """ The content hashes of the input files, from the store or hashed in `procs` processes """
+    stale = sorted(set(sam_file for sam_file in input_files if store.known_hash(sam_file) is None))
+    if stale:
+       pool = Pool(min(procs, len(stale)))
+       try:
+          for sam_file, digest in pool.imap_unordered(hash_job, stale):
+             store.set_hash(sam_file, digest)
+       finally:
+          pool.close()
+          pool.join()
+       store.save()
+    return [store.known_hash(sam_file) for sam_file in input_files]
+
+
+def main(input_files, gff_file, output_dir, extra_params, count_filename, umi="false", procs=0,
+         feature_cache="", engine="htseq", umi_collapse="none", bam_threads=1, matrix_format="tsv",
+         count_cache="", executor=None):
     """ HTSeq-count wrapper main. Counts input SAMs against given reference with given args.
-        Sums all counts in a table.
+        Sums all counts in a table. procs defaults to the number of cores.
+        The counts of each sample are kept in count_cache (default: count_store
+        in the output dir, "none" for no store), and samples that were counted
+        before with the same parameters are not counted again (see count_store.py).
+        The samples (or BAM regions) are counted by `executor` (see executors.py),
+        by default a LocalExecutor of procs processes.
     """
-    procs = int(procs)
+    logger = getLogger("pijp.htseq")
+    procs = int(procs or 0) or multiprocessing.cpu_count()
+    bam_threads = int(bam_threads)
+    assert (matrix_format in count_matrix.FORMATS), "Unknown matrix format %s" % matrix_format
     if umi.lower() in ["true","yes","1"]:
-        extra_params += " -u "
+        extra_params += " -u --umi-collapse " + umi_collapse
+    extra_params += " -e " + engine
+    index_dir = build_feature_index(extra_params, gff_file, feature_cache or os.path.join(output_dir, "feature_index"))
+    args = build_argument_opts(extra_params)
+    split_bams = args.samout == ""
+    rows = matrix_rows(index_dir, extra_params)
+    base_names = [os.path.splitext(os.path.basename(sam_file))[0] for sam_file in input_files]
+    #  we need base_names for heading the matrix file.
+
+    # the saved counts are not used when the assigned reads are to be written (samout)
+    store = None
+    if count_cache != "none" and args.samout == "":
+       store = count_store.CountStore(count_cache or os.path.join(output_dir, "count_store"))
+       params = count_store.params_key(index_dir, args)
+       digests = input_hashes(store, input_files, procs)
+
+    fd, columns_file = tempfile.mkstemp(dir=output_dir, suffix=".columns")
+    os.close(fd)
+    try:
+       # one column per sample, written as the samples finish
+       columns = numpy.memmap(columns_file, dtype=numpy.int64, mode="w+",
+                              shape=(len(rows), len(input_files)), order="F")
+       counted = 0
+       cmds = []     
+       # the sample of each command, and the number of commands (regions) of each sample
+       cmd_samples = []
+       sample_cmds = []
+       for sample, sam_file in enumerate(input_files):
+          saved = store.load(digests[sample], params) if store is not None else None
+          if saved is not None and len(saved) == len(rows):
+             columns[:, sample] = saved
+             counted += 1
+             sample_cmds.append(0)
+             continue
+          if split_bams and sam_file.endswith(".bam"):
+             regions = region_count.bam_regions(sam_file, procs)
+             htseq_cmds = [[extra_params, sam_file, gff_file, index_dir, region, bam_threads] for region in regions]
+          else:
+             htseq_cmds = [[extra_params, sam_file, gff_file, index_dir]]
+          cmd_samples += [sample] * len(htseq_cmds)
+          sample_cmds.append(len(htseq_cmds))
+          cmds += htseq_cmds
+       logger.info("%d samples were counted before, counting %d", counted, len(input_files) - counted)
+
+       # the merged results of the regions of BAM files, until all their regions are in
+       regions = dict()
+       # running htseq-count on multiple processes (or cluster jobs)
+       executor = executor or executors.LocalExecutor(procs)
+       for n, out in executor.imap_unordered(run_job, enumerate(cmds)):
+          sample = cmd_samples[n]
+          if len(cmds[n]) > 4:
+             parts = [part for part in (regions.pop(sample, None), out) if part is not None]
+             if parts:
+                regions[sample] = region_count.merge_results(parts)
+             sample_cmds[sample] -= 1
+             if sample_cmds[sample] > 0:
+                continue
+             out = merge_regions(input_files[sample], [regions.pop(sample, None)])
+          if out is None:
+             # HTSeq failed (perhaps empty file), so the column stays zeros.
+             continue
+          assert (len(out) == len(rows)), "%s has %d rows instead of %d" % (input_files[sample], len(out), len(rows))
+          columns[:, sample] = out
+          if store is not None:
+             store.store(digests[sample], params, out)
+          counted += 1
+          logger.info("counted %d of %d samples", counted, len(input_files))
+       if counted == 0:
+          raise TypeError("Error occured - no features for counting")
+       columns.flush()
+       count_matrix.write_matrix(rows, columns, base_names, os.path.join(output_dir, count_filename),
+                                 matrix_format)
+       del columns
+    finally:
+       os.remove(columns_file)
+
+def write_matrix(results, base_names, filename, matrix_format="tsv"):
+    """ Write the count matrix of the (feats, counts) results, one column per sample.
+        A result of None (HTSeq failed) is a column of zeros.
+    """
     # The first col we need only once, as it is always the same.
-    # So we put None, and try to write it on our first chance.
-    feats = None
-    counts = []
-    base_names = []
-    cmds = []     
-    # command arguments for each input SAM file
-    for sam_file in input_files:
-       base_names += [os.path.splitext(os.path.basename(sam_file))[0]] 
-        #  we need base_names for heading the matrix file.
-       htseq_cmd =  [extra_params, sam_file, gff_file]
-       cmds.append(htseq_cmd)
-     
-    # running htseq-count on multiple processes
-    pool = Pool(procs)
-    results = pool.map(run_cmd, cmds)
-    for res in results:
-        if res is None:
-            # HTSeq failed (perhaps empty file), so we put a column of zeros.
-            counts.append(cycle(["0"]))
-        else:
-            (feats_in, counts_in) = res
-            if feats is None:
-                feats = feats_in
-            counts.append(counts_in)
-    
-    # make a htseq-count matrix of results for output
-    matrix_header = ["#Sample:"] + base_names
+    feats = next((res[0] for res in results if res is not None), None)
     if feats is None:
         raise TypeError("Error occured - no features for counting")
-    matrix_header = ["#Sample:"] + base_names
-    matrix = zip( feats, *counts )
-    with open(os.path.join(output_dir, count_filename), "w") as fh:
-        matwriter = csv.writer(fh, delimiter='\t')
-        matwriter.writerow(matrix_header)
-        matwriter.writerows(matrix)
-        
+    # HTSeq failed (perhaps empty file) for the columns that stay zeros.
+    columns = numpy.zeros((len(feats), len(results)), dtype=numpy.int64)
+    for n, res in enumerate(results):
+        if res is not None:
+            columns[:, n] = res[1]
+    count_matrix.write_matrix(feats, columns, base_names, filename, matrix_format)
@@ -5,13 +5,26 @@ This pipeline accepts one argument only: a configuration file.
 Each section in the configuration file is related to a different step in the
 pipeline. The options are parsed here, but only few are used directly:
 
-  - pipe_run (boolean): decides whether this step should run at all.
+  - pipe_run (boolean): decides whether this step should run at all. A missing
+                        section does not run.
   - pipe_input_files (multiline string): the input file names. Can have several
                                          patterns, each on its own line. Each 
                                          pattern is exapnded to match existing
                                          files.
   - output_dir (string): This directory is created if non existent.
 
+A manifest of the finished sections is kept in each output_dir (see
+checkpoint.py). With --resume, the sections that finished with the same
+parameters and files are skipped, and so are the finished units of work (e.g.
+the samples that bowtie_wrapper aligned) of the others. With --force,
+everything is run again. Both run without asking about non-empty output
+directories.
+
+The optional [executor] section chooses where the per-sample units of work of
+bowtie_wrapper and htseq_wrapper run: `backend` is local (the default), or
+slurm, sge or fake for one job array per segment on a batch scheduler, with a
+`work_dir` on a shared filesystem (see executors.py).
+
 The rest of the parameters are passed as is to the relevant pipe segment.
 
 There are two important constants in this script:
@@ -27,15 +40,20 @@ from glob import glob
 import os
 import logging
 import json
+import inspect
 
-import bowtie_wrapper, bc_demultiplex, htseq_wrapper, clean_up
+import bowtie_wrapper, bc_demultiplex, collapse_reads, htseq_wrapper, align_count, sample_dag, clean_up
+import checkpoint
+import executors
 
 ###################################################################################################
 ## sections are the names of sections in the config file.
 ## segments are the functions you run. The segments and sections MUST be ordered
 ## the same way.
-SECTIONS = ( "bc_demultiplex", "bowtie_wrapper", "htseq_wrapper", "clean_up")
-SEGMENTS = ( bc_demultiplex.main, bowtie_wrapper.main, htseq_wrapper.main, clean_up.main)
+SECTIONS = ( "bc_demultiplex", "collapse_reads", "bowtie_wrapper", "htseq_wrapper", "align_count", "sample_dag",
+             "clean_up")
+SEGMENTS = ( bc_demultiplex.main, collapse_reads.main, bowtie_wrapper.main, htseq_wrapper.main, align_count.main,
+             sample_dag.main, clean_up.main)
 ###################################################################################################
 
 # some definitions for the loggers.
@@ -45,7 +63,7 @@ logger = logging.getLogger('pijp')
 logging.basicConfig(level=logging.INFO, format = LOGFORMAT)
 log_formatter = logging.Formatter(LOGFORMAT)
 
-def main(config_file):
+def main(config_file, resume=False, force=False):
     
     config = ConfigParser.ConfigParser()
     try:
@@ -57,9 +75,13 @@ def main(config_file):
     # does command do anything? called before handle is set. any point to it?
     logger.info("===== Started pijpleiding with config file : %s =====", config_file)
     
+    executor = None
+    if config.has_section("executor"):
+        executor = executors.from_config(config.items("executor"))
+
     for section, segment in zip(SECTIONS, SEGMENTS):
 
-        if config.getboolean(section, "pipe_run"):
+        if config.has_section(section) and config.getboolean(section, "pipe_run"):
             parameters = dict(config.items(section))
             parameters.pop("pipe_run")  #  Remove this from the dictionary, so it will not be passed to the segment.
 
@@ -74,7 +96,11 @@ def main(config_file):
             parameters["input_files"].sort()
 
             ##
-            create_dir(parameters['output_dir'])
+            create_dir(parameters['output_dir'], ask=not (resume or force))
+            manifest = checkpoint.Manifest(parameters['output_dir'], resume)
+            if manifest.section_done(section, parameters):
+                logger.info("Section %s finished before, skipping it", section)
+                continue
 
             # add a log file in the output dir
             log_fname = os.path.join(parameters['output_dir'], "pijp.log")
@@ -87,12 +113,23 @@ def main(config_file):
             logger.info("parameters : %s", json.dumps(parameters))
 
 
+            before = manifest.start_section(section)
+            # segments that keep their units of work get them from the manifest,
+            # and the executor that runs them
+            segment_parameters = dict(parameters)
+            if "units" in inspect.getargspec(segment).args:
+                segment_parameters["units"] = manifest.units(section)
+            if executor is not None and "executor" in inspect.getargspec(segment).args:
+                segment_parameters["executor"] = executor
+
             ####  run the command ============================================
             # that's the heart of the whole pipeline
             # in example, bc_demultiplex.main(parameters_from_log_file) 
-            segment(**parameters)
+            segment(**segment_parameters)
             #### =============================================================
 
+            manifest.finish_section(section, parameters, before)
+
             # remove the log file handler:
             logger.info("=========== closing log ===========")
             logger.removeHandler(hdlr)
@@ -103,21 +140,27 @@ def main(config_file):
 
 
 
-def create_dir(dirname):
+def create_dir(dirname, ask=True):
     ## create the output directory if nonexistant
     try:
         os.makedirs(dirname)
     except OSError:
         # directory already exists.. check if empty or
-        # perhaps has only pijp.log file. otherwise, prompt the user
-        if (len(os.listdir(dirname)) != 0) and (os.listdir(dirname) != ['pijp.log']):
-            ans = None
-            while ans not in ["y", "n"]:
-                print("Opening directory {0} ".format(dirname))
+        # perhaps has only pijp.log file (and the manifest). otherwise, prompt the user
+        if not ask or not (set(os.listdir(dirname)) - set(checkpoint.IGNORED)):
+            return
+        ans = None
+        while ans not in ["y", "n"]:
+            print("Opening directory {0} ".format(dirname))
+            try:
                 ans = raw_input("Writing to a non-empty directory. Files may be overwritten. Are you sure? [y/n] : ")
-            if ans == "n":
-                logger.info("Aborted by user because of non empty dir")
+            except EOFError:
+                logger.info("Aborted because of non empty dir %s and no answer. Use --resume or --force "
+                            "to run unattended.", dirname)
                 exit(1)
+        if ans == "n":
+            logger.info("Aborted by user because of non empty dir")
+            exit(1)
 
 
 if __name__ == "__main__":
@@ -125,5 +168,10 @@ if __name__ == "__main__":
     ##  Parse command line options. This adds the useful --help option.
     parser = argparse.ArgumentParser(description= __doc__, formatter_class=argparse.RawDescriptionHelpFormatter,)
     parser.add_argument('config_file', type=str)
+    rerun = parser.add_mutually_exclusive_group()
+    rerun.add_argument('--resume', action='store_true',
+                       help="skip the sections and units of work that finished before")
+    rerun.add_argument('--force', action='store_true',
+                       help="run everything again, writing to non-empty output dirs")
     args = parser.parse_args()
-    main(args.config_file)
+    main(args.config_file, args.resume, args.force)
@@ -0,0 +1,151 @@
+#!/usr/bin/python2
+""" Count a coordinate sorted, indexed BAM file by regions, in parallel.
+
+A single large alignment file is otherwise counted by one process. Here the
+chromosomes are split into regions of about the same number of mapped reads
+(from the BAM index), and every region is counted by count_features in a
+worker process, which reads its part of the file with pysam. The unmapped
+reads without a position are one more region. The counts, the summary
+counters and the UMI sets of the regions are then added up, so the result is
+the same as counting the whole file at once.
+
+A read belongs to the region in which it starts, so reads that cross a region
+border are counted once. pysam decompresses the BGZF blocks with `bam_threads`
+threads in each process.
+
+Single-end reads only: the mates of a coordinate sorted file are not next to
+each other, as the paired-end counting needs. A BAM file whose first read is
+paired is rejected (count a name sorted SAM file instead).
+"""
+
+from __future__ import print_function, division
+
+import shutil
+import tempfile
+from logging import getLogger
+from multiprocessing import Pool
+
+import htseq_count_umified
+import feature_index
+
+logger = getLogger('pijp.region_count')
+
+# the regions of each process, so a slow region does not hold up the others
+REGIONS_PER_PROC = 4
+UNPLACED = "*"
+
+
+def open_bam(bam_filename, bam_threads=1):
+    import pysam
+    return pysam.AlignmentFile(bam_filename, "rb", threads=bam_threads)
+
+
+def check_single_end(bam, bam_filename):
+    """ Raise ValueError if the first read of the BAM file is paired """
+    for read in bam.fetch(until_eof=True):
+        if read.is_paired:
+            raise ValueError("%s has paired-end reads, which cannot be counted from a coordinate sorted "
+                             "BAM file. Count a name sorted SAM file instead." % bam_filename)
+        break
+
+
+def bam_regions(bam_filename, procs):
+    """ The regions of a BAM file: (chrom, start, end) of about the same number
+        of mapped reads each, and UNPLACED for the unmapped reads without a position.
+    """
+    bam = open_bam(bam_filename)
+    try:
+        check_single_end(bam, bam_filename)
+        if not bam.has_index():
+            raise ValueError("%s has no index (samtools index)" % bam_filename)
+        stats = [(s.contig, s.mapped + s.unmapped) for s in bam.get_index_statistics()]
+        lengths = dict(zip(bam.references, bam.lengths))
+    finally:
+        bam.close()
+    total = sum(reads for chrom, reads in stats)
+    target = max(1, total // max(1, procs * REGIONS_PER_PROC))
+    regions = []
+    for chrom, reads in stats:
+        if reads == 0:
+            continue
+        # as if the reads were evenly spread over the chromosome
+        parts = max(1, min(reads // target, lengths[chrom]))
+        step = -(-lengths[chrom] // parts)
+        for start in xrange(0, lengths[chrom], step):
+            regions.append((chrom, start, min(start + step, lengths[chrom])))
+    regions.append(UNPLACED)
+    return regions
+
+
+def region_lines(bam, region):
+    """ Yield the SAM lines of the reads that start in the region (None for the whole file) """
+    if region is None:
+        reads = bam.fetch(until_eof=True)
+    elif region == UNPLACED:
+        reads = bam.fetch(UNPLACED)
+    else:
+        chrom, start, end = region
+        reads = (read for read in bam.fetch(chrom, start, end) if read.reference_start >= start)
+    for read in reads:
+        yield read.tostring(bam) + "\n"
+
+
+def count_region((bam_filename, region, args, bam_threads)):
+    """ Count the reads of one region. `args` are the arguments of count_features
+        after the SAM file. Returns (counts, umi counter, summary), or None if
+        the region has no reads.
+    """
+    bam = open_bam(bam_filename, bam_threads)
+    try:
+        return htseq_count_umified.count_features(region_lines(bam, region), *args)
+    except htseq_count_umified.EmptySamError:
+        return None
+    finally:
+        bam.close()
+
+
+def merge_results(results):
+    """ Add up the (counts, umi counter, summary) of the regions of a sample """
+    results = [result for result in results if result is not None]
+    if not results:
+        raise htseq_count_umified.EmptySamError("no alignments")
+    counts, umi_counts, summary = results[0]
+    summary = list(summary)
+    for other_counts, other_umis, other_summary in results[1:]:
+        for feature, count in other_counts.iteritems():
+            counts[feature] += count
+        if umi_counts is not None:
+            umi_counts.update(other_umis)
+        summary = [a + b for a, b in zip(summary, other_summary)]
+    return counts, umi_counts, tuple(summary)
+
+
+def count_bam(bam_filename, args, procs=1, bam_threads=1):
+    """ Count a BAM file with `procs` processes. Returns (counts, umi counter, summary) """
+    gff_filename, stranded, overlap_mode, feature_type, id_attribute = args[:5]
+    samout, umis, index_dir = args[7:10]
+    if samout != "" or procs <= 1:
+        bam = open_bam(bam_filename)
+        try:
+            check_single_end(bam, bam_filename)
+        finally:
+            bam.close()
+        # one pass over the whole file (the regions cannot write to the same SAM file)
+        return merge_results([count_region((bam_filename, None, args, bam_threads))])
+    regions = bam_regions(bam_filename, procs)
+    logger.info("counting %s in %d regions with %d processes", bam_filename, len(regions), procs)
+    tmp_dir = None
+    if index_dir is None:
+        # the regions share one feature index, instead of each parsing the GFF file
+        tmp_dir = tempfile.mkdtemp()
+        index_dir = feature_index.cached_index(gff_filename, feature_type, id_attribute, stranded, tmp_dir)
+        args = args[:9] + (index_dir,) + args[10:]
+    jobs = [(bam_filename, region, args, bam_threads) for region in regions]
+    pool = Pool(procs)
+    try:
+        return merge_results(pool.map(count_region, jobs))
+    finally:
+        pool.close()
+        pool.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,223 @@
+#!/usr/bin/python2
+""" Demultiplex, align and count every sample as soon as its input is ready.
+
+Running bc_demultiplex, bowtie_wrapper and htseq_wrapper one after the other
+waits for the slowest job of each stage, while the other cores are idle. Here
+the run is a graph of tasks on one pool of worker processes:
+
+  - demux : split one R1/R2 file pair into part files (as bc_demultiplex does
+            with several processes).
+  - merge : concatenate the parts of one sample, once every file that can have
+            its reads (the files of its lane and il_barcode) is split.
+  - align : run bowtie2 on the sample (number_of_threads threads).
+  - count : count the sample's SAM file (as htseq_wrapper does).
+
+A task starts as soon as the tasks it needs are done, so the first samples are
+counted while other files are still being split. The later stages go first,
+so samples finish early. `procs` is the number of cores to use (default: all
+of them). An align task runs bowtie2 with number_of_threads threads, so it
+takes that many cores, and the other tasks one. demux_procs, align_procs and
+count_procs limit the cores that the tasks of each stage take at once (0 for
+no limit but procs).
+
+All the outputs go to output_dir: the sample FASTQ files and the demux stats,
+the SAM files and the bowtie report, and the count matrix. They are the same
+as those of the separate sections. Container output is not supported.
+"""
+
+from __future__ import print_function, division
+
+import os
+import Queue
+import traceback
+import multiprocessing
+from logging import getLogger
+from collections import namedtuple, OrderedDict, Counter, defaultdict, deque
+from multiprocessing import Pool
+
+import numpy
+
+import bc_demultiplex
+import bowtie_wrapper
+import htseq_wrapper
+import count_matrix
+from fastq_input import fastq_base_name
+
+logger = getLogger('pijp.sample_dag')
+
+STAGES = ("demux", "merge", "align", "count")
+# seconds between checks for lost tasks (and for interrupts) while waiting for tasks
+WAIT = 1
+
+Task = namedtuple("Task", ["stage", "func", "arg", "deps"])
+
+
+def run_task((func, arg)):
+    """ Worker process: run one task. Returns (error, result) """
+    try:
+        return None, func(arg)
+    except Exception:
+        return traceback.format_exc(), None
+
+
+def run_graph(tasks, procs, limits=None, slots=None):
+    """ Run an OrderedDict of name -> Task on `procs` cores. A task starts when
+        the tasks named in its deps are done, and if the cores it takes fit in
+        procs and in limits[stage]. A task of a stage takes slots[stage] cores
+        (default 1, at most procs). Ready tasks of the later stages (in STAGES)
+        start first, the others in order. Returns name -> result.
+        Raises RuntimeError if a task fails, or if a worker process dies.
+    """
+    limits = limits or dict()
+    slots = slots or dict()
+    size = lambda stage: min(procs, slots.get(stage, 1))
+    remaining = dict((name, len(set(task.deps))) for name, task in tasks.iteritems())
+    dependents = defaultdict(list)
+    for name, task in tasks.iteritems():
+        for dep in set(task.deps):
+            dependents[dep].append(name)
+    ready = dict((stage, deque()) for stage in STAGES)
+    for name, task in tasks.iteritems():
+        if remaining[name] == 0:
+            ready[task.stage].append(name)
+
+    results = dict()
+    # the cores taken by the running tasks of each stage
+    running = Counter()
+    # name -> AsyncResult of the running tasks
+    pending = dict()
+    finished = Queue.Queue()
+    pool = Pool(procs)
+    # a worker that was killed (e.g. out of memory) is replaced by the pool,
+    # but its task never finishes
+    workers = set(worker.pid for worker in pool._pool)
+    try:
+        while True:
+            for stage in reversed(STAGES):
+                while (ready[stage] and sum(running.values()) + size(stage) <= procs and
+                       (not limits.get(stage) or running[stage] + size(stage) <= max(limits[stage], size(stage)))):
+                    name = ready[stage].popleft()
+                    running[stage] += size(stage)
+                    task = tasks[name]
+                    pending[name] = pool.apply_async(run_task, ((task.func, task.arg),),
+                                                     callback=lambda out, name=name: finished.put((name, out)))
+            if not pending:
+                break
+            while True:
+                try:
+                    name, (error, result) = finished.get(timeout=WAIT)
+                    break
+                except Queue.Empty:
+                    if set(worker.pid for worker in pool._pool) == workers:
+                        continue
+                    # the task of the dead worker is one of those that did not finish
+                    unfinished = sorted(name for name, async_result in pending.iteritems()
+                                        if not async_result.ready())
+                    if unfinished:
+                        raise RuntimeError("a worker process died (killed?) while running one of the tasks %s" %
+                                           ", ".join(unfinished))
+                    workers = set(worker.pid for worker in pool._pool)
+            del pending[name]
+            running[tasks[name].stage] -= size(tasks[name].stage)
+            if error is not None:
+                raise RuntimeError("task %s failed:\n%s" % (name, error))
+            results[name] = result
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready[tasks[dependent].stage].append(dependent)
+        assert (len(results) == len(tasks)), "tasks with missing dependencies: %s" % \
+            ", ".join(sorted(set(tasks) - set(results)))
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+
+def main(input_files, bc_index_file, sample_sheet, index_file, gff_file, output_dir, min_bc_quality=10,
+         umi_length=0, bc_length=8, cut_length=35, demux_engine="htseq", max_bc_mismatches=0,
+         output_compression="none", compression_level=6, stats_file="stats.tab", number_of_threads=3,
+         bowtie_params="", mm="false", bowtie_report_name="bt_report.tab", htseq_params="", umi="false",
+         umi_collapse="none", count_engine="htseq", feature_cache="", count_filename="expression.tab",
+         matrix_format="tsv", procs=0, demux_procs=0, align_procs=0, count_procs=0):
+    """ Demultiplex the input files, then align and count every sample. Writes
+        the demux stats, the bowtie report and the count matrix to output_dir.
+    """
+    procs = int(procs or 0) or multiprocessing.cpu_count()
+    limits = {"demux": int(demux_procs or 0), "align": int(align_procs or 0), "count": int(count_procs or 0)}
+    assert (matrix_format in count_matrix.FORMATS), "Unknown matrix format %s" % matrix_format
+    max_bc_mismatches = int(max_bc_mismatches)
+    split_args = dict(min_bc_quality=min_bc_quality, umi_length=int(umi_length), bc_length=int(bc_length),
+                      cut_length=int(cut_length), engine=demux_engine, max_bc_mismatches=max_bc_mismatches)
+    output_args = dict(compression=output_compression, level=int(compression_level), container="")
+    bc_dict = bc_demultiplex.create_bc_dict(bc_index_file)
+    sample_dict = bc_demultiplex.create_sample_dict(sample_sheet)
+    # distinct samples, in sample sheet order
+    samples = list(OrderedDict(((sample, True) for sample in sample_dict.values())))
+    filenames = bc_demultiplex.output_filenames(sample_dict, output_dir, output_compression)
+
+    bowtie_params = bowtie_wrapper.mm_params(bowtie_params, mm)
+    if umi.lower() in ["true", "yes", "1"]:
+        htseq_params += " -u --umi-collapse " + umi_collapse
+    htseq_params += " -e " + count_engine
+    index_dir = htseq_wrapper.build_feature_index(htseq_params, gff_file,
+                                                  feature_cache or os.path.join(output_dir, "feature_index"))
+
+    tasks = OrderedDict()
+    jobs = bc_demultiplex.split_jobs(input_files, 1)
+    demux_tasks = []
+    # the demux tasks (parts) that can have reads of each sample
+    sample_parts = defaultdict(list)
+    for part, (fastq_file, chunk) in enumerate(jobs):
+        name = "demux:%d" % part
+        tasks[name] = Task("demux", bc_demultiplex.split_part, (part, fastq_file, chunk, bc_dict, sample_dict,
+                                                                output_dir, split_args, output_args), [])
+        demux_tasks.append(name)
+        for sample in bc_demultiplex.file_samples(fastq_file, sample_dict):
+            sample_parts[sample].append(part)
+    for key in ("unknown_bc_R1", "unknown_bc_R2"):
+        tasks["merge:" + key] = Task("merge", bc_demultiplex.merge_parts,
+                                     (filenames[key], range(len(jobs)), output_compression), demux_tasks)
+    for sample in samples:
+        fastq_file = filenames[sample]
+        # a sample that no file has reads of still gets an (empty) file
+        parts = sample_parts[sample] or [0]
+        tasks["merge:" + fastq_file] = Task("merge", bc_demultiplex.merge_parts,
+                                            (fastq_file, parts, output_compression),
+                                            ["demux:%d" % part for part in parts])
+        cmd = bowtie_wrapper.build_bowtie_command(fastq_file, index_file, number_of_threads, output_dir,
+                                                  bowtie_params)
+        tasks["align:" + fastq_file] = Task("align", bowtie_wrapper.run_cmd, (cmd, fastq_file, None),
+                                            ["merge:" + fastq_file])
+        sam_file = bowtie_wrapper.sam_filename(fastq_file, output_dir)
+        tasks["count:" + fastq_file] = Task("count", htseq_wrapper.run_cmd,
+                                            [htseq_params, sam_file, gff_file, index_dir],
+                                            ["align:" + fastq_file])
+
+    logger.info("running %d tasks of %d samples on %d cores", len(tasks), len(samples), procs)
+    results = run_graph(tasks, procs, limits, {"align": int(number_of_threads)})
+
+    # the parts of the samples that a file could not have reads of are empty
+    for part in range(len(jobs)):
+        for filename in filenames.values():
+            if os.path.exists(bc_demultiplex.FN_PART.format(filename, part)):
+                os.remove(bc_demultiplex.FN_PART.format(filename, part))
+
+    sample_counter = sum((results[name] for name in demux_tasks), Counter())
+    bc_demultiplex.write_stats(sample_counter, sample_dict, os.path.join(output_dir, stats_file),
+                               corrections=(max_bc_mismatches > 0))
+    bowtie_wrapper.write_report([results["align:" + filenames[sample]] for sample in samples],
+                                os.path.join(output_dir, bowtie_report_name))
+    rows = htseq_wrapper.matrix_rows(index_dir, htseq_params)
+    columns = numpy.zeros((len(rows), len(samples)), dtype=numpy.int64)
+    for n, sample in enumerate(samples):
+        column = results["count:" + filenames[sample]]
+        # a column of zeros if HTSeq failed (perhaps empty file)
+        if column is not None:
+            columns[:, n] = column
+    base_names = [fastq_base_name(filenames[sample]) for sample in samples]
+    count_matrix.write_matrix(rows, columns, base_names, os.path.join(output_dir, count_filename), matrix_format)
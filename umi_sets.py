@@ -0,0 +1,218 @@
+#!/usr/bin/python2
+""" Compact sets of the UMIs counted for each feature.
+
+bc_demultiplex puts the UMI at the end of the read name ("<name>:UMI:<umi>:").
+The UMI is taken from that fixed position once its length is known; names in
+any other form go through the regex htseq-count used before.
+
+UMIs of A, C, G and T are 2-bit encoded into integers. For short UMIs of the
+usual length, each feature gets a bitset of all the possible UMIs (4^length
+bits). Longer UMIs are kept as a set of integers, and UMIs with other letters
+(e.g. N) as a set of strings. Nothing is allocated for features without reads.
+
+Sequencing errors in the UMIs make the counts of highly expressed features
+too high. With `collapse`, the number of reads of each UMI is kept instead,
+and UMIs one mismatch apart are merged before counting:
+
+  - hamming     : UMIs that are linked by one-mismatch neighbours are one molecule.
+  - directional : as UMI-tools' directional method, a UMI with a reads
+                  takes in a neighbour with b reads only if a >= 2b - 1.
+
+The neighbours are found by trying the 3 other bases at every position (4 for
+UMIs with N) against the hash of observed UMIs, so the time is linear in the
+number of UMIs of a feature.
+"""
+
+from __future__ import print_function, division
+
+import re
+import string
+import binascii
+from collections import deque
+
+UMI_RE = re.compile(":UMI:(\w+):")
+UMI_TAG = ":UMI:"
+# bitsets are used up to this UMI length (512 bytes per feature)
+BITSET_MAX_LENGTH = 6
+COLLAPSE_MODES = ("none", "hamming", "directional")
+# A, C, G, T to base 4 digits, anything else to "x"
+BASE4 = string.maketrans("".join(chr(c) for c in range(256)),
+                         "".join({"A": "0", "C": "1", "G": "2", "T": "3"}.get(chr(c), "x") for c in range(256)))
+
+
+def encode_umi(umi):
+    """ The UMI as an integer, 2 bits per base after a leading 1 bit (so "A" and
+        "AA" differ). None if it has other letters than A, C, G and T.
+    """
+    try:
+        return int("1" + umi.translate(BASE4), 4)
+    except ValueError:
+        return None
+
+
+def decode_umi(code):
+    digits = []
+    while code > 1:
+        digits.append("ACGT"[code & 3])
+        code >>= 2
+    return "".join(reversed(digits))
+
+
+def neighbours(umi, with_n=False):
+    """ The UMIs one mismatch away, each encoded if it can be. With with_n,
+        also the UMIs with an N in place of one base.
+    """
+    if isinstance(umi, basestring):
+        for pos in xrange(len(umi)):
+            for base in "ACGTN":
+                if base != umi[pos]:
+                    other = umi[:pos] + base + umi[pos + 1:]
+                    code = encode_umi(other)
+                    yield other if code is None else code
+        return
+    pos = 0
+    while (umi >> pos) > 1:
+        for delta in (1, 2, 3):
+            yield umi ^ (delta << pos)
+        pos += 2
+    if with_n:
+        bases = decode_umi(umi)
+        for pos in xrange(len(bases)):
+            yield bases[:pos] + "N" + bases[pos + 1:]
+
+
+def count_molecules(read_counts, collapse):
+    """ The number of molecules in the {UMI: reads} dict of a feature """
+    if collapse == "none":
+        return len(read_counts)
+    directional = collapse == "directional"
+    # N variants are only looked for if there are UMIs with other letters
+    with_n = any(isinstance(umi, basestring) for umi in read_counts)
+    found = set()
+    molecules = 0
+    # the UMIs with the most reads start the clusters
+    for umi in sorted(read_counts, key=read_counts.get, reverse=True):
+        if umi in found:
+            continue
+        molecules += 1
+        found.add(umi)
+        queue = deque([umi])
+        while queue:
+            node = queue.popleft()
+            node_reads = read_counts[node]
+            for other in neighbours(node, with_n):
+                if other in found or other not in read_counts:
+                    continue
+                if directional and node_reads < 2 * read_counts[other] - 1:
+                    continue
+                found.add(other)
+                queue.append(other)
+    return molecules
+
+
+def bitset_codes(bits, umi_length):
+    """ The encoded UMIs of a bitset """
+    top = 1 << (2 * umi_length)
+    for i, byte in enumerate(bits):
+        if byte:
+            for bit in xrange(8):
+                if byte & (1 << bit):
+                    yield top | (i * 8 + bit)
+
+
+class UmiCounter(object):
+    """ Counts the distinct UMIs of each feature, or the molecules if UMIs are
+        collapsed.
+    """
+
+    def __init__(self, bitset_max_length=BITSET_MAX_LENGTH, collapse="none"):
+        assert (collapse in COLLAPSE_MODES), "Unknown UMI collapsing %s" % collapse
+        self.bitset_max_length = bitset_max_length
+        self.collapse = collapse
+        self.umi_length = None
+        # feature -> bytearray, for the UMIs of umi_length
+        self.bitsets = dict()
+        # feature -> set of the other UMIs (integers, or strings that cannot be encoded)
+        self.others = dict()
+        # when collapsing: feature -> {UMI: reads}
+        self.read_counts = dict()
+
+    def umi_of(self, read_name):
+        """ The UMI of a read name """
+        n = self.umi_length
+        if n is not None and read_name[-n - 6:-n - 1] == UMI_TAG and read_name[-1] == ":":
+            return read_name[-n - 1:-1]
+        umi = UMI_RE.search(read_name).group(1)
+        if n is None and read_name.endswith(UMI_TAG + umi + ":"):
+            self.umi_length = len(umi)
+        return umi
+
+    def add(self, feature, read_name):
+        umi = self.umi_of(read_name)
+        code = encode_umi(umi)
+        if self.collapse != "none":
+            key = umi if code is None else code
+            feature_counts = self.read_counts.get(feature)
+            if feature_counts is None:
+                feature_counts = self.read_counts[feature] = dict()
+            feature_counts[key] = feature_counts.get(key, 0) + 1
+        elif code is None:
+            self.others.setdefault(feature, set()).add(umi)
+        elif len(umi) == self.umi_length and self.umi_length <= self.bitset_max_length:
+            bits = self.bitsets.get(feature)
+            if bits is None:
+                bits = self.bitsets[feature] = bytearray(max(1, 4 ** self.umi_length // 8))
+            # without the leading 1 bit
+            index = code ^ (1 << (2 * self.umi_length))
+            bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self.others.setdefault(feature, set()).add(code)
+
+    def update(self, other):
+        """ Add the UMIs of another UmiCounter (e.g. of another region of the sample) """
+        if self.umi_length is None:
+            self.umi_length = other.umi_length
+        for feature, bits in other.bitsets.iteritems():
+            if other.umi_length == self.umi_length:
+                own = self.bitsets.get(feature)
+                if own is None:
+                    self.bitsets[feature] = bytearray(bits)
+                else:
+                    for i, byte in enumerate(bits):
+                        if byte:
+                            own[i] |= byte
+            else:
+                # a different length was learned there, so these go to the other UMIs
+                self.others.setdefault(feature, set()).update(bitset_codes(bits, other.umi_length))
+        for feature, umis in other.others.iteritems():
+            self.others.setdefault(feature, set()).update(umis)
+        for feature, umi_reads in other.read_counts.iteritems():
+            own = self.read_counts.setdefault(feature, dict())
+            for umi, reads in umi_reads.iteritems():
+                own[umi] = own.get(umi, 0) + reads
+
+    def raw_count(self, feature):
+        """ The number of distinct UMIs of a feature """
+        if self.collapse != "none":
+            return len(self.read_counts.get(feature, ()))
+        others = self.others.get(feature, ())
+        bits = self.bitsets.get(feature)
+        if bits is None:
+            return len(others)
+        n = bin(int(binascii.hexlify(bits), 16)).count("1")
+        # UMIs seen before umi_length was learned (here or in a merged counter)
+        # went to the other UMIs, and may be in the bitset as well
+        top = 1 << (2 * self.umi_length)
+        for umi in others:
+            if isinstance(umi, basestring) or umi >> (2 * self.umi_length) != 1:
+                n += 1
+            else:
+                index = umi ^ top
+                n += not (bits[index >> 3] & (1 << (index & 7)))
+        return n
+
+    def count(self, feature):
+        """ The number of molecules of a feature """
+        if self.collapse == "none":
+            return self.raw_count(feature)
+        return count_molecules(self.read_counts.get(feature, {}), self.collapse)